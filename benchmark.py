@@ -0,0 +1,399 @@
+"""Offline benchmark of the add_customer_match_user_list Cloud Function.
+
+Generates synthetic CRM exports and uploads them through the whole pipeline of
+main.add_customer_match_user_list, with cloud storage and the Google Ads
+services replaced by in-process fakes, so that no Google service is called.
+Each size runs in its own process, so that the peak memory of a run is not
+hidden by the runs before it. With --repeat, the file is uploaded several times
+in that process, like the invocations served by a warm instance, which shows
+the effect of the caches kept between invocations.
+
+Usage:
+    python benchmark.py --rows 10000 100000 1000000 10000000
+    python benchmark.py --rows 100000 --format csv.gz --options '{"hash_processes": 1}'
+    python benchmark.py --rows 100000 --rpc-latency 0.2 --json > results.json
+    python benchmark.py --rows 100000 --options '{"partition": {"column": "Country", "user_lists": {"US": 1, "FR": 2}}}'
+    python benchmark.py --rows 100000 --repeat 2
+"""
+import argparse
+import contextlib
+import csv
+import gzip
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import flask
+from google.ads.googleads.client import GoogleAdsClient
+from google.auth.credentials import AnonymousCredentials
+
+import main
+
+
+DEFAULT_ROWS = (10000, 100000, 1000000, 10000000)
+BENCHMARK_FORMATS = ("csv", "csv.gz")
+BUCKET_NAME = "benchmark"
+CUSTOMER_ID = "1234567890"
+USER_LIST_ID = "987654321"
+# Columns of a CRM export that the function does not read.
+EXTRA_COLUMNS = ("Customer ID", "Signup date", "Lifetime value")
+
+
+def generate_crm_csv(path, rows, compress=False, seed=0):
+    """Writes a synthetic CRM export, in the layout the function expects.
+    Values have the stray whitespace and mixed case of real exports, and some
+    records lack a phone number or a complete mailing address. About 1% of
+    the records repeat an earlier user.
+    Args:
+        path: The path of the file to write.
+        rows: The number of records.
+        compress: If true, the file is compressed with gzip.
+        seed: The seed of the random generator.
+    """
+    rng = random.Random(seed)
+    first_names = ["Ann", "Bob", "Carla", "Dinh", "Emeka", "Fatima", "Goran", "Hana"]
+    last_names = ["Lee", "Smith", "Garcia", "Nguyen", "Okafor", "Khan", "Novak", "Sato"]
+    countries = ["US", "GB", "FR", "DE", "JP", "BR"]
+    opener = gzip.open if compress else open
+    with opener(path, "wt", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(main.USER_LIST_COLUMNS + EXTRA_COLUMNS)
+        for row in range(rows):
+            user = rng.randrange(row) if row and rng.random() < 0.01 else row
+            first_name = first_names[user % len(first_names)]
+            last_name = last_names[user // len(first_names) % len(last_names)]
+            email = f" {first_name}.{last_name}{user}@Example.com "
+            phone = f"+1 555 {user:07d}" if user % 10 else ""
+            address = user % 20 != 0
+            writer.writerow(
+                (
+                    email,
+                    phone,
+                    first_name,
+                    f" {last_name} " if address else "",
+                    countries[user % len(countries)] if address else "",
+                    f"{10000 + user % 90000}" if address else "",
+                    user,
+                    f"2023-{1 + user % 12:02d}-{1 + user % 28:02d}",
+                    f"{rng.random() * 1000:.2f}",
+                )
+            )
+
+
+class FakeBlob:
+    """Stand-in for google.cloud.storage.Blob, stored as a local file."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+        self.content_encoding = None
+        self.path = os.path.join(bucket.root, name.replace("/", "__"))
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def open(self, mode="r", chunk_size=None, content_type=None, **kwargs):
+        if "r" in mode and not self.exists():
+            raise FileNotFoundError(self.name)
+        if content_type is not None:
+            self.content_type = content_type
+        if "b" in mode:
+            return open(self.path, mode)
+        return open(self.path, mode, newline=kwargs.get("newline"), encoding=kwargs.get("encoding"))
+
+    def upload_from_string(self, data, content_type=None):
+        with open(self.path, "wb") as file:
+            file.write(data.encode() if isinstance(data, str) else data)
+
+    def download_as_bytes(self):
+        with open(self.path, "rb") as file:
+            return file.read()
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class FakeBucket:
+    """Stand-in for google.cloud.storage.Bucket, stored as a local directory."""
+
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        blob = self.blob(name)
+        return blob if blob.exists() else None
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        shutil.copyfile(blob.path, destination_bucket.blob(new_name).path)
+
+
+class FakeStorageClient:
+    """Stand-in for google.cloud.storage.Client, whose buckets are
+    directories of a local directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._buckets = {}
+
+    def bucket(self, name):
+        if name not in self._buckets:
+            path = os.path.join(self.root, name)
+            os.makedirs(path, exist_ok=True)
+            self._buckets[name] = FakeBucket(path, name)
+        return self._buckets[name]
+
+    get_bucket = bucket
+
+
+class FakeOfflineUserDataJobService:
+    """Stand-in for OfflineUserDataJobService which accepts every operation.
+    Requests are serialized, as gRPC would, so that their cost is measured,
+    and an optional latency simulates the round trip to the API.
+    """
+
+    def __init__(self, ga_client, latency=0.0):
+        self._ga_client = ga_client
+        self._real = ga_client.get_service("OfflineUserDataJobService")
+        self.latency = latency
+        self.requests = {}
+        self.operations = 0
+        self.request_bytes = 0
+        self._lock = threading.Lock()
+
+    def _count(self, method):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def offline_user_data_job_path(self, customer_id, offline_user_data_job_id):
+        return self._real.offline_user_data_job_path(customer_id, offline_user_data_job_id)
+
+    def create_offline_user_data_job(self, customer_id, job):
+        self._count("create_offline_user_data_job")
+        return types.SimpleNamespace(resource_name=f"customers/{customer_id}/offlineUserDataJobs/1")
+
+    def add_offline_user_data_job_operations(self, request):
+        serialized = type(request).serialize(request)
+        if self.latency:
+            time.sleep(self.latency)
+        self._count("add_offline_user_data_job_operations")
+        with self._lock:
+            self.operations += len(request.operations)
+            self.request_bytes += len(serialized)
+        return self._ga_client.get_type("AddOfflineUserDataJobOperationsResponse")
+
+    def run_offline_user_data_job(self, resource_name):
+        self._count("run_offline_user_data_job")
+
+
+class FakeGoogleAdsService:
+    """Stand-in for GoogleAdsService which reports every job with job_status,
+    pending by default, and every user list as an empty list.
+    """
+
+    def __init__(self, ga_client, job_service):
+        self._ga_client = ga_client
+        self._real = ga_client.get_service("GoogleAdsService")
+        self._job_service = job_service
+        self.job_status = "PENDING"
+        self.membership_life_span = 30
+
+    def user_list_path(self, customer_id, user_list_id):
+        return self._real.user_list_path(customer_id, user_list_id)
+
+    def search(self, customer_id, query):
+        self._job_service._count("search")
+        return self._rows(query)
+
+    def search_stream(self, customer_id, query):
+        self._job_service._count("search_stream")
+        return [types.SimpleNamespace(results=self._rows(query))]
+
+    def _rows(self, query):
+        """Returns a row for each job and user list named in the query."""
+        rows = []
+        for resource_name in re.findall(r"'(customers/\d+/offlineUserDataJobs/\d+)'", query):
+            row = self._ga_client.get_type("GoogleAdsRow")
+            job = row.offline_user_data_job
+            job.resource_name = resource_name
+            job.id = int(resource_name.rsplit("/", 1)[-1])
+            job.status = self._ga_client.enums.OfflineUserDataJobStatusEnum[self.job_status]
+            job.type_ = self._ga_client.enums.OfflineUserDataJobTypeEnum.CUSTOMER_MATCH_USER_LIST
+            rows.append(row)
+        for resource_name in re.findall(r"'(customers/\d+/userLists/\d+)'", query):
+            row = self._ga_client.get_type("GoogleAdsRow")
+            user_list = row.user_list
+            user_list.resource_name = resource_name
+            user_list.id = int(resource_name.rsplit("/", 1)[-1])
+            user_list.name = f"User list {user_list.id}"
+            user_list.membership_life_span = self.membership_life_span
+            rows.append(row)
+        return rows
+
+
+def make_google_ads_client(rpc_latency=0.0):
+    """Returns a GoogleAdsClient whose services used by the function are fakes.
+    Args:
+        rpc_latency: Seconds slept by each AddOfflineUserDataJobOperations call.
+    Returns:
+        A tuple of the client and its FakeOfflineUserDataJobService.
+    """
+    ga_client = GoogleAdsClient(
+        credentials=AnonymousCredentials(), developer_token="benchmark", use_proto_plus=True
+    )
+    job_service = FakeOfflineUserDataJobService(ga_client, rpc_latency)
+    fakes = {
+        "OfflineUserDataJobService": job_service,
+        "GoogleAdsService": FakeGoogleAdsService(ga_client, job_service),
+    }
+    get_service = ga_client.get_service
+    ga_client.get_service = lambda name, version=None: fakes.get(name) or get_service(name, version)
+    return ga_client, job_service
+
+
+def run_benchmark(path, rows, options, rpc_latency=0.0):
+    """Uploads a generated file through add_customer_match_user_list.
+    Args:
+        path: The path of the generated file.
+        rows: The number of records in the file.
+        options: Dict of extra fields of the request body.
+        rpc_latency: Seconds slept by each AddOfflineUserDataJobOperations call.
+    Returns:
+        A dict with the results of the run.
+    """
+    root = tempfile.mkdtemp(prefix="customer-match-benchmark-")
+    try:
+        storage_client = FakeStorageClient(root)
+        blob_name = os.path.basename(path)
+        shutil.copyfile(path, storage_client.bucket(BUCKET_NAME).blob(blob_name).path)
+        ga_client, job_service = make_google_ads_client(rpc_latency)
+        main.refresh_clients()
+        with main._clients_lock:
+            main._google_ads_client = ga_client
+            main._storage_client = storage_client
+
+        body = {
+            "bucket_name": BUCKET_NAME,
+            "blob_name": blob_name,
+            "customer_id": CUSTOMER_ID,
+            # Partition mode takes its user lists from the partition option.
+            **({} if "partition" in options else {"user_list_id": USER_LIST_ID}),
+            **options,
+            "metrics": True,
+        }
+        app = flask.Flask(__name__)
+        start = time.perf_counter()
+        # The function logs several lines per run, which would swamp the results.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            with app.test_request_context(method="POST", json=body):
+                response = main.add_customer_match_user_list(flask.request)
+        wall_seconds = time.perf_counter() - start
+        response_data = response.get_json(silent=True) or response.get_data(as_text=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        "rows": rows,
+        "input_bytes": os.path.getsize(path),
+        "status_code": response.status_code,
+        "wall_seconds": round(wall_seconds, 3),
+        "rows_per_second": round(rows / wall_seconds, 1),
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "requests": job_service.requests,
+        "operations": job_service.operations,
+        "request_bytes": job_service.request_bytes,
+        "stages": response_data["metrics"]["stages"] if isinstance(response_data, dict) else {},
+        "response": response_data,
+    }
+
+
+def print_results(results):
+    """Prints the results of the runs as tables."""
+    for result in results:
+        print(
+            f"\n{result['rows']} rows ({result['input_bytes']} bytes), invocation {result['invocation']}: "
+            f"HTTP {result['status_code']}, {result['wall_seconds']} s, "
+            f"{result['rows_per_second']} rows/s, peak RSS {result['peak_rss_bytes'] // 2**20} MiB, "
+            f"{result['operations']} operations in {result['request_bytes']} bytes"
+        )
+        print("  requests: " + ", ".join(f"{method} {count}" for method, count in result["requests"].items()))
+        print(f"  {'stage':<14}{'seconds':>10}{'calls':>8}{'rows':>10}{'rows/s':>12}{'MiB':>10}{'RSS MiB':>10}")
+        for name, stage in result["stages"].items():
+            print(
+                f"  {name:<14}{stage['seconds']:>10.3f}{stage['calls']:>8}{stage['rows']:>10}"
+                f"{stage['rows_per_second'] or 0:>12.0f}{stage['bytes'] / 2**20:>10.1f}"
+                f"{stage['max_rss_bytes'] / 2**20:>10.0f}"
+            )
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS, help="Sizes of the generated files.")
+    parser.add_argument("--format", choices=BENCHMARK_FORMATS, default="csv", help="Format of the generated files.")
+    parser.add_argument("--options", type=json.loads, default={}, help="JSON object of extra request fields.")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="Seconds slept by each upload request.")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "customer-match-benchmark"),
+                        help="Directory where the generated files are kept between runs.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated files.")
+    parser.add_argument("--repeat", type=int, default=1, help="Uploads of each file in the same process.")
+    parser.add_argument("--json", action="store_true", help="Prints the results as JSON.")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # Runs a single size in this process, for the parent process.
+        results = []
+        for invocation in range(args.repeat):
+            result = run_benchmark(args.run, args.rows[0], args.options, args.rpc_latency)
+            results.append({"invocation": invocation + 1, **result})
+        print(json.dumps(results))
+        return
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = []
+    for rows in args.rows:
+        path = os.path.join(args.data_dir, f"crm-{rows}-{args.seed}.{args.format}")
+        if not os.path.exists(path):
+            print(f"Generating {path}...", file=sys.stderr)
+            generate_crm_csv(path, rows, compress=args.format == "csv.gz", seed=args.seed)
+        print(f"Uploading {rows} rows...", file=sys.stderr)
+        process = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__),
+                "--run", path,
+                "--rows", str(rows),
+                "--options", json.dumps(args.options),
+                "--rpc-latency", str(args.rpc_latency),
+                "--repeat", str(args.repeat),
+            ],
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        results.extend(json.loads(process.stdout.decode().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,46 @@
+"""Normalization and hashing of user identifiers.
+This module only depends on the standard library, so that the worker
+processes which hash identifiers for main.py start without importing the
+Google Ads, gRPC and Flask packages.
+"""
+import hashlib
+
+
+def normalize_and_hash(s, remove_all_whitespace):
+    """Normalizes and hashes a string with SHA-256.
+    Args:
+        s: The string to perform this operation on.
+        remove_all_whitespace: If true, removes leading, trailing, and
+            intermediate spaces from the string before hashing. If false, only
+            removes leading and trailing spaces from the string before hashing.
+    Returns:
+        A normalized (lowercase, remove whitespace) and SHA-256 hashed string.
+    """
+    s = normalize(s, remove_all_whitespace)
+
+    # Hashes the normalized string using the hashing algorithm.
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def normalize(s, remove_all_whitespace):
+    """Normalizes a string before it is hashed.
+    Args:
+        s: The string to perform this operation on.
+        remove_all_whitespace: If true, removes leading, trailing, and
+            intermediate spaces from the string. If false, only removes leading
+            and trailing spaces from the string.
+    Returns:
+        The normalized string.
+    """
+    # Normalizes by first converting all characters to lowercase, then trimming
+    # spaces.
+    if remove_all_whitespace:
+        # Removes leading, trailing, and intermediate whitespace.
+        return "".join(s.split())
+    # Removes only leading and trailing spaces.
+    return s.strip().lower()
+
+
+def normalize_and_hash_task(values, remove_all_whitespace):
+    """Normalizes and hashes a list of strings. Runs in a worker process."""
+    return [normalize_and_hash(value, remove_all_whitespace) for value in values]
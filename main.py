@@ -1,17 +1,162 @@
+import base64
+import bisect
+import contextlib
+import cProfile
 import csv
 import functions_framework
+import grpc
+import gzip
 import hashlib
+import heapq
+import io
+import itertools
+import json
+import multiprocessing
 import os
+import random
+import re
+import resource
+import threading
+import time
+import weakref
+
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 from flask import jsonify, make_response
 from google.ads.googleads.client import GoogleAdsClient
 from google.ads.googleads.errors import GoogleAdsException
+from google.api_core.exceptions import GoogleAPIError
 from google.cloud import storage
 
+import hashing
+from hashing import normalize_and_hash_task
+
+# Kept in this module, where it used to be defined, for its callers.
+normalize_and_hash = hashing.normalize_and_hash
 
 os.environ["GOOGLE_ADS_CONFIGURATION_FILE_PATH"] = "google-ads.yaml"
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "silken-tenure-383314-4699d25cba08.json"
 
+# Size of the byte ranges requested from cloud storage while streaming the
+# user list. Only one chunk is held in memory at a time.
+GCS_CHUNK_SIZE = 8 * 1024 * 1024
+# Default limits of a single AddOfflineUserDataJobOperations request. Larger
+# uploads are split into several requests against the same job. See
+# https://developers.google.com/google-ads/api/docs/best-practices/quotas#user_data
+MAX_OPERATIONS_PER_REQUEST = 10000
+MAX_REQUEST_BYTES = 8 * 1024 * 1024
+# Number of AddOfflineUserDataJobOperations requests sent at the same time.
+# At most this many batches, plus the one being filled, are held in memory.
+MAX_REQUESTS_IN_FLIGHT = 4
+# Number of records whose identifier columns are normalized and hashed together.
+RECORDS_CHUNK_SIZE = 10000
+# Number of values hashed by a worker process in a single task.
+HASH_TASK_SIZE = 2000
+# Columns of the user list used to build the operations. Other columns are not
+# read.
+USER_LIST_COLUMNS = ("Email", "Phone", "First name", "Last name", "Country", "Zip")
+# Columns whose values are hashed. They can be declared as pre-hashed.
+HASHED_COLUMNS = ("Email", "Phone", "First name", "Last name")
+# Pre-hashed values must be hex-encoded SHA-256 digests.
+_SHA256_HEX_PATTERN = re.compile(r"[0-9a-f]{64}")
+# Supported formats of the user list blob.
+FILE_FORMATS = ("csv", "csv.gz", "ndjson", "ndjson.gz", "parquet")
+# Number of worker processes used to hash identifiers: the CPUs this process
+# may run on, which follows the CPU quota of the instance rather than the CPUs
+# of the host. With 1 or less, values are hashed in the calling process.
+# Requests cannot ask for more.
+HASH_PROCESSES = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+# Highest max_requests_in_flight a request can ask for.
+MAX_REQUESTS_IN_FLIGHT_LIMIT = 16
+
+# Process pool of HASH_PROCESSES workers shared by the invocations served by
+# this instance.
+_hash_executor = None
+_hash_executor_lock = threading.Lock()
+
+# Number of distinct users tracked exactly, by their serialized UserData,
+# before deduplication switches to 64-bit fingerprints.
+DEDUP_EXACT_MAX_ENTRIES = 100000
+
+# Number of manifest entries processed at the same time by
+# add_customer_match_user_lists, and the default number of them that may
+# belong to the same customer, to stay within the customer's quota.
+FAN_OUT_MAX_WORKERS = 8
+FAN_OUT_MAX_WORKERS_PER_CUSTOMER = 2
+# Highest max_workers a request can ask for. Each entry also runs up to
+# max_requests_in_flight upload threads.
+FAN_OUT_MAX_WORKERS_LIMIT = 16
+
+# Maximum number of resource names in the IN (...) condition of a GAQL query.
+GAQL_MAX_IN_VALUES = 1000
+# Resource names of offline user data jobs and user lists.
+_RESOURCE_NAME_PATTERN = re.compile(r"customers/\d+/(offlineUserDataJobs|userLists)/\d+")
+
+# Minimum number of seconds between two writes of an upload checkpoint.
+CHECKPOINT_INTERVAL_SECONDS = 10
+# Options of add_customer_match_user_list which only apply to a single user
+# list, and cannot be combined with a partition.
+PARTITION_INCOMPATIBLE_OPTIONS = ("user_list_id", "offline_user_data_job_id", "delta", "checkpoint", "resume")
+# Directory where the profiles of profiled requests are written. Only /tmp is
+# writable in Cloud Functions.
+PROFILE_DIR = "/tmp/profiles"
+
+# Prefix, within the input bucket, of the snapshots of the members uploaded to
+# each user list, used by delta uploads.
+USER_LIST_SNAPSHOT_PREFIX = "customer_match_snapshots/"
+# Membership life span, in days, of the user lists created by this function,
+# and the special value of an unlimited life span.
+USER_LIST_MEMBERSHIP_LIFE_SPAN = 30
+USER_LIST_UNLIMITED_LIFE_SPAN = 10000
+# A delta upload becomes a full upload, which renews the membership of every
+# member, once the last full upload is this many days from the end of the
+# membership life span of the user list.
+DELTA_REFRESH_MARGIN_DAYS = 5
+
+# Clients shared by the invocations served by this instance. They are created
+# on first use and kept until refresh_clients is called.
+_google_ads_client = None
+_storage_client = None
+# Services of each Google Ads client, keyed by service name.
+_services = weakref.WeakKeyDictionary()
+# OfflineUserDataJobOperationBuilder by Google Ads client.
+_operation_builders = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+# Requests per second sent for a customer: initial rate, bounds, and the burst
+# of requests allowed after an idle period. The rate grows by
+# RATE_LIMIT_INCREASE after each successful request, and is multiplied by
+# RATE_LIMIT_DECREASE_FACTOR when the API throttles the customer.
+RATE_LIMIT_INITIAL_RATE = 5.0
+RATE_LIMIT_MIN_RATE = 0.1
+RATE_LIMIT_MAX_RATE = 50.0
+RATE_LIMIT_BURST = 4
+RATE_LIMIT_INCREASE = 0.1
+RATE_LIMIT_DECREASE_FACTOR = 0.5
+# Rate limiters shared by the invocations served by this instance, keyed by
+# customer ID, so that the rate learned by one upload is used by the next.
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+# Attempts, and bounds of the jittered exponential backoff between them, of
+# the calls that upload operations and run jobs.
+RETRY_MAX_ATTEMPTS = 6
+RETRY_INITIAL_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 60.0
+# gRPC status codes of the errors that are retried. Adding operations and
+# running a job are not idempotent, and a call that failed with a transient
+# status such as UNAVAILABLE or DEADLINE_EXCEEDED may still have been applied,
+# so only quota errors, which reject the call, are retried.
+RETRYABLE_STATUS_CODES = ("RESOURCE_EXHAUSTED",)
+# HTTP status codes of the responses to gRPC errors which are not Google Ads
+# API failures. Other gRPC errors are answered with a 500.
+GRPC_ERROR_HTTP_STATUS_CODES = {
+    "RESOURCE_EXHAUSTED": 429,
+    "UNAVAILABLE": 503,
+    "DEADLINE_EXCEEDED": 504,
+}
+
 
 @functions_framework.http
 def add_customer_match_user_list(request):
@@ -30,70 +175,613 @@ def add_customer_match_user_list(request):
         request_data = request.get_json(force=True)
 
         if request_data:
-            if any([
-                ("bucket_name" not in request_data),
-                ("blob_name" not in request_data),
-                ("customer_id" not in request_data)
-            ]):
-                return make_response("Not enough data", 400)
-
-            bucket_name = request_data["bucket_name"]
-            blob_name = request_data["blob_name"]
-            customer_id = request_data["customer_id"]
-
-            ga_client = GoogleAdsClient.load_from_storage()
-
-            raw_records = get_file_from_gcs(blob_name=blob_name, bucket_name=bucket_name)
-
-            try:
-                googleads_service = ga_client.get_service("GoogleAdsService")
-
-                if ("user_list_id" in request_data):
-                    user_list_id = request_data["user_list_id"]
-                    # Override the user_list if it already exists.
-                    replace = True
-                    # Uses the specified Customer Match user list.
-                    user_list_resource_name = googleads_service.user_list_path(
-                        customer_id, user_list_id
-                    )
-                else:
-                    # Creates a Customer Match user list.
-                    user_list_resource_name = create_customer_match_user_list(
-                        ga_client, customer_id
-                    )
-                    replace = False
-
-                job = add_users_to_customer_match_user_list(
-                    ga_client=ga_client,
-                    customer_id=customer_id,
-                    user_list_resource_name=user_list_resource_name,
-                    run_job=True,
-                    replace=replace,
-                    records=raw_records
+            if request_data.get("refresh_clients"):
+                refresh_clients()
+            if request_data.get("profile"):
+                # Profiles the upload with cProfile and reports where the
+                # profile was written.
+                (body, status_code), profile_path = run_profiled(
+                    upload_customer_match_user_list, request_data
                 )
+                if isinstance(body, dict):
+                    body["profile"] = profile_path
+                return _make_response(body, status_code)
+            return _make_response(*upload_customer_match_user_list(request_data))
 
-                # If run_job is False.
-                if not job:
-                    return make_response("Not running offline user data job", 200)
+        else:
+            return make_response("Bad request", 400)
 
-                response = make_response(jsonify({"status": job.status.name, "job_id": job.id}), 200)
-                response.headers["Content-Type"] = "application/json"
-                return response
 
-            except GoogleAdsException as ex:
-                print(
-                    f"Request with ID '{ex.request_id}' failed with status "
-                    f"'{ex.error.code().name}' and includes the following errors:"
+def upload_customer_match_user_list(request_data):
+    """Uploads the members in a blob to a Customer Match user list.
+    This is the body of add_customer_match_user_list, shared with the batch
+    endpoint add_customer_match_user_lists.
+    Args:
+        request_data: Dict with the "bucket_name", "blob_name" and
+            "customer_id", and optionally the "user_list_id" and the options
+            accepted by add_customer_match_user_list.
+    Returns:
+        A tuple of the response body, either a string or a dict serialized as
+        JSON, and the HTTP status code.
+    """
+    if any([
+        ("bucket_name" not in request_data),
+        ("blob_name" not in request_data),
+        ("customer_id" not in request_data)
+    ]):
+        return "Not enough data", 400
+
+    bucket_name = request_data["bucket_name"]
+    blob_name = request_data["blob_name"]
+    customer_id = request_data["customer_id"]
+    if not str(request_data.get("offline_user_data_job_id", "0")).isdigit():
+        return "Invalid offline user data job ID", 400
+    if request_data.get("format") not in (None,) + FILE_FORMATS:
+        return "Invalid file format", 400
+    # Columns which already hold SHA-256 hex digests, or true for all of them.
+    pre_hashed_columns = request_data.get("pre_hashed_columns") or ()
+    if pre_hashed_columns is True:
+        pre_hashed_columns = HASHED_COLUMNS
+    if not isinstance(pre_hashed_columns, (list, tuple)) or not set(pre_hashed_columns) <= set(HASHED_COLUMNS):
+        return "Invalid pre-hashed columns", 400
+    # Returns as soon as the job is submitted, without checking its status.
+    asynchronous = bool(request_data.get("async"))
+    try:
+        max_operations_per_request = int(
+            request_data.get("max_operations_per_request", MAX_OPERATIONS_PER_REQUEST)
+        )
+        max_request_bytes = int(request_data.get("max_request_bytes", MAX_REQUEST_BYTES))
+        max_requests_in_flight = int(
+            request_data.get("max_requests_in_flight", MAX_REQUESTS_IN_FLIGHT)
+        )
+        hash_processes = int(request_data.get("hash_processes", HASH_PROCESSES))
+    except (TypeError, ValueError):
+        return "Invalid request limits", 400
+    if min(max_operations_per_request, max_request_bytes, max_requests_in_flight) < 1:
+        return "Invalid request limits", 400
+    # The thread and process pools are bounded by the resources of the instance.
+    max_requests_in_flight = min(max_requests_in_flight, MAX_REQUESTS_IN_FLIGHT_LIMIT)
+    hash_processes = min(hash_processes, HASH_PROCESSES)
+    if request_data.get("resume") and "user_list_id" not in request_data:
+        # A new user list would be created, which no checkpoint belongs to.
+        return "Resume requires a user_list_id", 400
+    # Routes the records to several user lists by the value of a column.
+    partition = request_data.get("partition")
+    if partition is not None:
+        partition = parse_partition(partition)
+        if partition is None:
+            return "Invalid partition", 400
+        if any(key in request_data for key in PARTITION_INCOMPATIBLE_OPTIONS):
+            return f"Partition mode does not support {', '.join(PARTITION_INCOMPATIBLE_OPTIONS)}", 400
+
+    # Times every stage of the upload. The metrics are always logged, and
+    # returned when requested.
+    metrics = UploadMetrics()
+    ga_client = get_google_ads_client()
+
+    try:
+        # Rows are parsed lazily, in batches of columns, while the operations
+        # are uploaded.
+        record_batches = get_record_batches_from_gcs(
+            blob_name=blob_name,
+            bucket_name=bucket_name,
+            file_format=request_data.get("format"),
+            metrics=metrics,
+            extra_columns=(partition["column"],) if partition is not None else (),
+        )
+    except MalformedFileError as e:
+        metrics.log()
+        print(f"Malformed file: {e}")
+        return {"message": "Malformed file", "error": str(e)}, 400
+    except Exception as e:
+        message = "Failed to get file from cloud storage"
+        print(f"{message}: {e}")
+        return {"message": message, "error": str(e)}, 404
+
+    try:
+        googleads_service = get_service(ga_client, "GoogleAdsService")
+
+        if partition is not None:
+            # Every user list is fed from a single pass over the blob.
+            response_data = upload_partitioned_customer_match_user_lists(
+                ga_client=ga_client,
+                customer_id=customer_id,
+                bucket_name=bucket_name,
+                blob_name=blob_name,
+                partition=partition,
+                record_batches=record_batches,
+                max_operations_per_request=max_operations_per_request,
+                max_request_bytes=max_request_bytes,
+                max_requests_in_flight=max_requests_in_flight,
+                hash_executor=get_hash_executor(hash_processes),
+                pre_hashed_columns=pre_hashed_columns,
+                deduplicate=bool(request_data.get("deduplicate", True)),
+                check_status=not asynchronous,
+                metrics=metrics,
+            )
+            metrics.log()
+        else:
+            if ("user_list_id" in request_data):
+                user_list_id = request_data["user_list_id"]
+                # Override the user_list if it already exists.
+                replace = True
+                # Uses the specified Customer Match user list.
+                user_list_resource_name = googleads_service.user_list_path(
+                    customer_id, user_list_id
+                )
+            else:
+                # Creates a Customer Match user list.
+                user_list_resource_name = create_customer_match_user_list(
+                    ga_client, customer_id
+                )
+                user_list_id = user_list_resource_name.rsplit("/", 1)[-1]
+                replace = False
+
+            offline_user_data_job_id = request_data.get("offline_user_data_job_id")
+            checkpoint = None
+            if request_data.get("checkpoint") or request_data.get("resume"):
+                checkpoint = UploadCheckpoint(
+                    get_storage_client().bucket(bucket_name), blob_name, customer_id, user_list_id
+                )
+                if request_data.get("resume") and not offline_user_data_job_id:
+                    # Resumes the job of the interrupted upload of this blob to
+                    # the same user list, if there is one.
+                    offline_user_data_job_id = checkpoint.job_id(user_list_resource_name)
+
+            snapshot = None
+            upload_stats = {}
+            # Rejected operations are mapped back to their source rows.
+            failure_report = PartialFailureReport(
+                get_storage_client().bucket(bucket_name), blob_name, customer_id, user_list_id
+            )
+            if request_data.get("delta"):
+                # Only the difference with the last successful upload to the user
+                # list is sent.
+                snapshot = UserListSnapshot(
+                    get_storage_client().bucket(bucket_name), customer_id, user_list_id
                 )
-                for error in ex.failure.errors:
-                    print(f"\tError with message '{error.message}'.")
-                    if error.location:
-                        for field_path_element in error.location.field_path_elements:
-                            print(f"\t\tOn field: {field_path_element.field_name}")
-                return make_response(ex.error.code().name, 400)
 
+            job = add_users_to_customer_match_user_list(
+                ga_client=ga_client,
+                customer_id=customer_id,
+                user_list_resource_name=user_list_resource_name,
+                run_job=True,
+                replace=replace,
+                records=None,
+                record_batches=record_batches,
+                offline_user_data_job_id=offline_user_data_job_id,
+                max_operations_per_request=max_operations_per_request,
+                max_request_bytes=max_request_bytes,
+                max_requests_in_flight=max_requests_in_flight,
+                hash_executor=get_hash_executor(hash_processes),
+                pre_hashed_columns=pre_hashed_columns,
+                snapshot=snapshot,
+                deduplicate=bool(request_data.get("deduplicate", True)),
+                check_status=not asynchronous,
+                checkpoint=checkpoint,
+                stats=upload_stats,
+                failure_report=failure_report,
+                metrics=metrics,
+            )
+            metrics.log()
+
+            # If run_job is False.
+            if not job:
+                return "Not running offline user data job", 200
+
+            if asynchronous:
+                # The job handle can be passed to get_offline_user_data_job_status
+                # to follow the job.
+                response_data = {
+                    "customer_id": customer_id,
+                    "job_id": int(job.rsplit("/", 1)[-1]),
+                    "job_resource_name": job,
+                }
+            else:
+                response_data = {"status": job.status.name, "job_id": job.id}
+            response_data["partial_failures"] = failure_report.summary()
+            response_data["retries"] = upload_stats["retries"]
+            if "duplicates_dropped" in upload_stats:
+                response_data["duplicates_dropped"] = upload_stats["duplicates_dropped"]
+            if snapshot is not None:
+                response_data["delta"] = upload_stats["delta"]
+        if request_data.get("metrics"):
+            response_data["metrics"] = metrics.summary()
+        return response_data, 200
+
+    except GoogleAdsException as ex:
+        print(
+            f"Request with ID '{ex.request_id}' failed with status "
+            f"'{ex.error.code().name}' and includes the following errors:"
+        )
+        for error in ex.failure.errors:
+            print(f"\tError with message '{error.message}'.")
+            if error.location:
+                for field_path_element in error.location.field_path_elements:
+                    print(f"\t\tOn field: {field_path_element.field_name}")
+        return ex.error.code().name, 400
+
+    except grpc.RpcError as ex:
+        status = _status_code_name(ex) or "UNKNOWN"
+        print(f"Request failed with status '{status}': {ex}")
+        return status, GRPC_ERROR_HTTP_STATUS_CODES.get(status, 500)
+
+    except MalformedFileError as e:
+        # The rows read so far are uploaded, but the job is not run.
+        metrics.log()
+        print(f"Malformed file: {e}")
+        return {"message": "Malformed file", "error": str(e)}, 400
+
+
+def parse_partition(partition):
+    """Validates the "partition" option of add_customer_match_user_list.
+    The option is a dict with the "column" which routes the records, the
+    "user_lists" mapping each value of the column to a user list ID or a list
+    of them, and optionally the "separator" of several values in a cell.
+    Args:
+        partition: The value of the option.
+    Returns:
+        A dict with the "column", the "user_lists" mapping each value to a
+        list of user list IDs, and the "separator", or None if the option is
+        invalid.
+    """
+    if not isinstance(partition, dict):
+        return None
+    column = partition.get("column")
+    user_lists = partition.get("user_lists")
+    separator = partition.get("separator")
+    if not isinstance(column, str) or not isinstance(user_lists, dict) or not user_lists:
+        return None
+    if separator is not None and (not isinstance(separator, str) or not separator):
+        return None
+    user_list_ids = {}
+    for value, ids in user_lists.items():
+        ids = ids if isinstance(ids, list) else [ids]
+        if not ids or not all(str(user_list_id).isdigit() for user_list_id in ids):
+            return None
+        user_list_ids[value] = [str(user_list_id) for user_list_id in ids]
+    return {"column": column, "user_lists": user_list_ids, "separator": separator}
+
+
+def upload_partitioned_customer_match_user_lists(
+    ga_client, customer_id, bucket_name, blob_name, partition, record_batches, **options
+):
+    """Uploads the members in a blob to the user lists of a partition.
+    Args:
+        ga_client: The Google Ads client.
+        customer_id: The ID for the customer that owns the user lists.
+        bucket_name: The bucket name in cloud storage.
+        blob_name: The name of the blob.
+        partition: The partition, as returned by parse_partition.
+        record_batches: Iterable of RecordBatch holding the partition column.
+        options: Keyword arguments passed to
+            add_users_to_partitioned_customer_match_user_lists.
+    Returns:
+        The response data, with a result for each user list and the number of
+        rows that matched no user list.
+    """
+    googleads_service = get_service(ga_client, "GoogleAdsService")
+    user_list_resource_names = {
+        value: [googleads_service.user_list_path(customer_id, user_list_id) for user_list_id in ids]
+        for value, ids in partition["user_lists"].items()
+    }
+    bucket = get_storage_client().bucket(bucket_name)
+    # The failures of each user list are reported next to the input blob,
+    # in a report named after the customer and the user list.
+    failure_reports = {
+        resource_name: PartialFailureReport(
+            bucket, blob_name, customer_id, resource_name.rsplit("/", 1)[-1]
+        )
+        for resource_names in user_list_resource_names.values()
+        for resource_name in resource_names
+    }
+    stats = {}
+    results = add_users_to_partitioned_customer_match_user_lists(
+        ga_client,
+        customer_id,
+        user_list_resource_names,
+        partition["column"],
+        record_batches,
+        separator=partition["separator"],
+        failure_reports=failure_reports,
+        stats=stats,
+        **options,
+    )
+
+    response_data = {"user_lists": [], "rows_unrouted": stats["rows_unrouted"]}
+    for resource_name, result in results.items():
+        job = result["job"]
+        user_list_data = {"user_list_id": resource_name.rsplit("/", 1)[-1]}
+        if isinstance(job, str):
+            user_list_data["job_id"] = int(job.rsplit("/", 1)[-1])
+            user_list_data["job_resource_name"] = job
         else:
-            return make_response("Bad request", 400)
+            user_list_data["job_id"] = job.id
+            user_list_data["status"] = job.status.name
+        user_list_data["operations_sent"] = result["operations_sent"]
+        user_list_data["retries"] = result["retries"]
+        if "duplicates_dropped" in result:
+            user_list_data["duplicates_dropped"] = result["duplicates_dropped"]
+        user_list_data["partial_failures"] = failure_reports[resource_name].summary()
+        if "error" in result:
+            user_list_data["error"] = result["error"]
+        response_data["user_lists"].append(user_list_data)
+    return response_data
+
+
+@functions_framework.http
+def add_customer_match_user_lists(request):
+    """HTTP Cloud Function which uploads many blobs to many user lists.
+    The request body holds a "manifest", a list of entries with the same
+    fields as the body of add_customer_match_user_list. Any other field of the
+    body is used as a default for every entry. The entries share the clients,
+    the hashing process pool and a pool of max_workers threads, and at most
+    max_workers_per_customer entries of the same customer run at a time.
+
+    Args:
+        request (flask.Request): The request object.
+        <https://flask.palletsprojects.com/en/1.1.x/api/#incoming-request-data>
+    Returns:
+        The response text, or any set of values that can be turned into a
+        Response object using `make_response`
+        <https://flask.palletsprojects.com/en/1.1.x/api/#flask.make_response>.
+    """
+    if request.method != "POST":
+        return make_response("Bad request", 400)
+    request_data = request.get_json(force=True)
+    if not request_data or not isinstance(request_data.get("manifest"), list):
+        return make_response("Not enough data", 400)
+
+    defaults = {key: value for key, value in request_data.items() if key != "manifest"}
+    try:
+        max_workers = int(defaults.pop("max_workers", FAN_OUT_MAX_WORKERS))
+        max_workers_per_customer = int(
+            defaults.pop("max_workers_per_customer", FAN_OUT_MAX_WORKERS_PER_CUSTOMER)
+        )
+    except (TypeError, ValueError):
+        return make_response("Invalid request limits", 400)
+    if min(max_workers, max_workers_per_customer) < 1:
+        return make_response("Invalid request limits", 400)
+    # The thread pool is bounded by the resources of the instance.
+    max_workers = min(max_workers, FAN_OUT_MAX_WORKERS_LIMIT)
+    max_workers_per_customer = min(max_workers_per_customer, max_workers)
+    if not all(isinstance(entry, dict) for entry in request_data["manifest"]):
+        return make_response("Invalid manifest", 400)
+
+    if defaults.pop("refresh_clients", False):
+        refresh_clients()
+    entries = [{**defaults, **entry} for entry in request_data["manifest"]]
+    results = upload_customer_match_user_lists(entries, max_workers, max_workers_per_customer)
+
+    response = make_response(jsonify({"results": results}), 200)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+def upload_customer_match_user_lists(
+    entries,
+    max_workers=FAN_OUT_MAX_WORKERS,
+    max_workers_per_customer=FAN_OUT_MAX_WORKERS_PER_CUSTOMER,
+):
+    """Runs upload_customer_match_user_list for many entries on a shared pool.
+    Entries are started in order, skipping over entries whose customer already
+    has max_workers_per_customer entries running, so that one customer with
+    many entries does not hold up the others.
+    Args:
+        entries: List of dicts, each accepted by upload_customer_match_user_list.
+        max_workers: Maximum number of entries processed at the same time.
+        max_workers_per_customer: Maximum number of entries of the same
+            customer processed at the same time.
+    Returns:
+        A list with a dict for each entry, in the order of the entries, holding
+        the "status_code" and the "response" of its upload.
+    """
+    results = [None] * len(entries)
+    pending = list(range(len(entries)))
+    running = {}
+    running_per_customer = {}
+
+    def customer_of(index):
+        return str(entries[index].get("customer_id"))
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="user-list-upload") as executor:
+        while pending or running:
+            # Starts every pending entry whose customer is below its cap.
+            for index in list(pending):
+                if len(running) >= max_workers:
+                    break
+                customer_id = customer_of(index)
+                if running_per_customer.get(customer_id, 0) >= max_workers_per_customer:
+                    continue
+                pending.remove(index)
+                running_per_customer[customer_id] = running_per_customer.get(customer_id, 0) + 1
+                running[executor.submit(upload_customer_match_user_list, entries[index])] = index
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                running_per_customer[customer_of(index)] -= 1
+                try:
+                    body, status_code = future.result()
+                except Exception as e:
+                    print(f"Upload of manifest entry {index} failed: {e}")
+                    body, status_code = {"message": "Upload failed", "error": str(e)}, 500
+                results[index] = {
+                    "blob_name": entries[index].get("blob_name"),
+                    "customer_id": entries[index].get("customer_id"),
+                    "user_list_id": entries[index].get("user_list_id"),
+                    "status_code": status_code,
+                    "response": body,
+                }
+
+    return results
+
+
+def _make_response(body, status_code):
+    """Builds the HTTP response for a body returned by upload_customer_match_user_list."""
+    if isinstance(body, dict):
+        response = make_response(jsonify(body), status_code)
+        response.headers["Content-Type"] = "application/json"
+        return response
+    return make_response(body, status_code)
+
+
+@functions_framework.http
+def get_offline_user_data_job_status(request):
+    """HTTP Cloud Function which returns the status of offline user data jobs
+    and the size of user lists.
+    The request body holds either a "customer_id" with a "job_id" or a list of
+    "job_ids", as returned by add_customer_match_user_list, or a list of
+    "job_resource_names" which may belong to several customers. It may also
+    hold a "customer_id" with a list of "user_list_ids", or a list of
+    "user_list_resource_names". The jobs and the user lists of each customer
+    are each retrieved with as few queries as possible.
+
+    Args:
+        request (flask.Request): The request object.
+        <https://flask.palletsprojects.com/en/1.1.x/api/#incoming-request-data>
+    Returns:
+        The response text, or any set of values that can be turned into a
+        Response object using `make_response`
+        <https://flask.palletsprojects.com/en/1.1.x/api/#flask.make_response>.
+    """
+    if request.method != "POST":
+        return make_response("Bad request", 400)
+    request_data = request.get_json(force=True)
+    if not request_data:
+        return make_response("Not enough data", 400)
+
+    job_resource_names = list(request_data.get("job_resource_names", []))
+    user_list_resource_names = list(request_data.get("user_list_resource_names", []))
+    job_ids = list(request_data.get("job_ids", []))
+    if "job_id" in request_data:
+        job_ids.insert(0, request_data["job_id"])
+    user_list_ids = list(request_data.get("user_list_ids", []))
+    if job_ids or user_list_ids:
+        if "customer_id" not in request_data:
+            return make_response("Not enough data", 400)
+        customer_id = str(request_data["customer_id"])
+        job_resource_names = [
+            f"customers/{customer_id}/offlineUserDataJobs/{job_id}" for job_id in job_ids
+        ] + job_resource_names
+        user_list_resource_names = [
+            f"customers/{customer_id}/userLists/{user_list_id}" for user_list_id in user_list_ids
+        ] + user_list_resource_names
+    if not job_resource_names and not user_list_resource_names:
+        return make_response("Not enough data", 400)
+    # The resource names are interpolated into the queries, so they must be
+    # well formed.
+    if not all(
+        _RESOURCE_NAME_PATTERN.fullmatch(str(resource_name))
+        for resource_name in job_resource_names + user_list_resource_names
+    ):
+        return make_response("Invalid resource names", 400)
+
+    ga_client = get_google_ads_client()
+    try:
+        jobs = get_offline_user_data_jobs(ga_client, job_resource_names)
+        user_lists = get_user_lists(ga_client, user_list_resource_names)
+    except GoogleAdsException as ex:
+        print(
+            f"Request with ID '{ex.request_id}' failed with status "
+            f"'{ex.error.code().name}'."
+        )
+        return make_response(ex.error.code().name, 400)
+
+    response_data = {"jobs": []}
+    for resource_name in job_resource_names:
+        job = jobs.get(resource_name)
+        if job is None:
+            response_data["jobs"].append({
+                "resource_name": resource_name,
+                "job_id": int(resource_name.rsplit("/", 1)[-1]),
+                "status": "NOT_FOUND",
+            })
+            continue
+        response_data["jobs"].append({
+            "resource_name": resource_name,
+            "job_id": job.id,
+            "status": job.status.name,
+            "failure_reason": job.failure_reason.name,
+            "user_list": job.customer_match_user_list_metadata.user_list,
+        })
+    if user_list_resource_names:
+        response_data["user_lists"] = []
+        for resource_name in user_list_resource_names:
+            user_list = user_lists.get(resource_name)
+            if user_list is None:
+                response_data["user_lists"].append({
+                    "resource_name": resource_name,
+                    "status": "NOT_FOUND",
+                })
+                continue
+            response_data["user_lists"].append({
+                "resource_name": resource_name,
+                "user_list_id": user_list.id,
+                "name": user_list.name,
+                "size_for_display": user_list.size_for_display,
+                "size_for_search": user_list.size_for_search,
+            })
+    response = make_response(jsonify(response_data), 200)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+def get_google_ads_client():
+    """Returns the Google Ads client of this instance.
+    The client is loaded from the configuration file on first use and reused
+    by later invocations, so the configuration is parsed and the credentials
+    are built only once per instance.
+    Returns:
+        A GoogleAdsClient.
+    """
+    global _google_ads_client
+    with _clients_lock:
+        if _google_ads_client is None:
+            _google_ads_client = GoogleAdsClient.load_from_storage()
+        return _google_ads_client
+
+
+def get_storage_client():
+    """Returns the cloud storage client of this instance, creating it on first use.
+    Returns:
+        A google.cloud.storage.Client.
+    """
+    global _storage_client
+    with _clients_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+def get_service(ga_client, name):
+    """Returns a Google Ads service client, reusing its gRPC channel.
+    Each call to GoogleAdsClient.get_service opens a new channel, so the
+    service clients are cached per Google Ads client and service name.
+    Args:
+        ga_client: The Google Ads client.
+        name: The name of the service, for example "GoogleAdsService".
+    Returns:
+        The service client.
+    """
+    with _clients_lock:
+        services = _services.setdefault(ga_client, {})
+        if name not in services:
+            services[name] = ga_client.get_service(name)
+        return services[name]
+
+
+def refresh_clients():
+    """Drops the cached clients, so that the next invocation builds new ones.
+    This reloads the Google Ads configuration and credentials, and opens new
+    channels.
+    """
+    global _google_ads_client, _storage_client
+    with _clients_lock:
+        _google_ads_client = None
+        _storage_client = None
+        _services.clear()
+        _operation_builders.clear()
 
 
 def create_customer_match_user_list(client, customer_id, list_name="Customer Match list"):
@@ -105,7 +793,7 @@ def create_customer_match_user_list(client, customer_id, list_name="Customer Mat
         The string resource name of the newly created user list.
     """
     # Creates the UserListService client.
-    user_list_service_client = client.get_service("UserListService")
+    user_list_service_client = get_service(client, "UserListService")
 
     # Creates the user list operation.
     user_list_operation = client.get_type("UserListOperation")
@@ -125,7 +813,7 @@ def create_customer_match_user_list(client, customer_id, list_name="Customer Mat
     # life span must be between 0 and 540 days inclusive. See:
     # https://developers.devsite.corp.google.com/google-ads/api/reference/rpc/latest/UserList#membership_life_span
     # Sets the membership life span to 30 days.
-    user_list.membership_life_span = 30
+    user_list.membership_life_span = USER_LIST_MEMBERSHIP_LIFE_SPAN
 
     response = user_list_service_client.mutate_user_lists(
         customer_id=customer_id, operations=[user_list_operation]
@@ -138,6 +826,39 @@ def create_customer_match_user_list(client, customer_id, list_name="Customer Mat
     return user_list_resource_name
 
 
+def create_offline_user_data_job(ga_client, customer_id, user_list_resource_name):
+    """Creates an offline user data job which adds users to a user list.
+    Args:
+        ga_client: The Google Ads client.
+        customer_id: The ID for the customer that owns the user list.
+        user_list_resource_name: The resource name of the user list.
+    Returns:
+        The resource name of the job.
+    """
+    offline_user_data_job_service_client = get_service(
+        ga_client, "OfflineUserDataJobService"
+    )
+    offline_user_data_job = ga_client.get_type("OfflineUserDataJob")
+    offline_user_data_job.type_ = (
+        ga_client.enums.OfflineUserDataJobTypeEnum.CUSTOMER_MATCH_USER_LIST
+    )
+    offline_user_data_job.customer_match_user_list_metadata.user_list = (
+        user_list_resource_name
+    )
+    # Issues a request to create an offline user data job.
+    create_offline_user_data_job_response = offline_user_data_job_service_client.create_offline_user_data_job(
+        customer_id=customer_id, job=offline_user_data_job
+    )
+    offline_user_data_job_resource_name = (
+        create_offline_user_data_job_response.resource_name
+    )
+    print(
+        "Created an offline user data job with resource name: "
+        f"'{offline_user_data_job_resource_name}'."
+    )
+    return offline_user_data_job_resource_name
+
+
 def add_users_to_customer_match_user_list(
     ga_client,
     customer_id,
@@ -146,6 +867,20 @@ def add_users_to_customer_match_user_list(
     replace,
     records,
     offline_user_data_job_id=None,
+    max_operations_per_request=MAX_OPERATIONS_PER_REQUEST,
+    max_request_bytes=MAX_REQUEST_BYTES,
+    max_requests_in_flight=MAX_REQUESTS_IN_FLIGHT,
+    hash_executor=None,
+    snapshot=None,
+    deduplicate=True,
+    check_status=True,
+    checkpoint=None,
+    stats=None,
+    record_batches=None,
+    pre_hashed_columns=(),
+    failure_report=None,
+    metrics=None,
+    rate_limiter=None,
 ):
     """Uses Customer Match to create and add users to a new user list.
     Args:
@@ -156,17 +891,52 @@ def add_users_to_customer_match_user_list(
         run_job: If true, runs the OfflineUserDataJob after adding operations.
             Otherwise, only adds operations to the job.
         replace: True when the user list already exists, if true, replaces the existing list with the new list.
-        records: List of raw records. Each element of the list represents a single user and is a dict containing
+        records: Iterable of raw records. Each element represents a single user and is a dict containing
             separate entry for the keys "email", "phone", "first_name", "last_name",
-            "country_code", and "postal_code".
+            "country_code", and "postal_code". The records are consumed lazily.
         offline_user_data_job_id: ID of an existing OfflineUserDataJob in the
             PENDING state. If None, a new job is created.
+        max_operations_per_request: Maximum number of operations sent in a
+            single AddOfflineUserDataJobOperations request.
+        max_request_bytes: Maximum serialized size of the operations sent in a
+            single AddOfflineUserDataJobOperations request.
+        max_requests_in_flight: Maximum number of
+            AddOfflineUserDataJobOperations requests sent concurrently.
+        hash_executor: Optional process pool used to normalize and hash the
+            identifiers. If None, they are hashed in the calling process.
+        snapshot: Optional UserListSnapshot of the user list. If given and a
+            previous snapshot exists, only the users added since the previous
+            upload are created and the users dropped since are removed,
+            instead of replacing the whole list. The snapshot is updated once
+            all operations are added to the job.
+        deduplicate: If true, only the first record of users that have the
+            same hashed identifiers is uploaded.
+        check_status: If true, retrieves the status of the job once it runs.
+            Otherwise, returns as soon as the job is submitted.
+        checkpoint: Optional UploadCheckpoint recording the rows whose
+            operations were acknowledged. If it already holds rows of the same
+            job, those rows are skipped, which resumes an interrupted upload.
+        stats: Optional dict which is filled with counters of the upload.
+        record_batches: Optional iterable of RecordBatch, read instead of the
+            records.
+        pre_hashed_columns: Names of the columns of HASHED_COLUMNS whose
+            values are already SHA-256 hex digests. They are used as is.
+        failure_report: Optional PartialFailureReport which records the
+            operations rejected by the job, and is saved once the operations
+            are added.
+        metrics: Optional UploadMetrics which records the time spent in each
+            stage of the upload.
+        rate_limiter: Optional RateLimiter of the requests that upload the
+            operations and run the job. Defaults to the one of the customer.
     Returns:
-        The offline user data job or None if run_job is False.
+        The offline user data job, its resource name if check_status is False,
+        or None if run_job is False.
     """
+    metrics = metrics or UploadMetrics()
+    rate_limiter = rate_limiter or get_rate_limiter(customer_id)
     # Creates the OfflineUserDataJobService client.
-    offline_user_data_job_service_client = ga_client.get_service(
-        "OfflineUserDataJobService"
+    offline_user_data_job_service_client = get_service(
+        ga_client, "OfflineUserDataJobService"
     )
 
     if offline_user_data_job_id:
@@ -176,115 +946,483 @@ def add_users_to_customer_match_user_list(
         )
     else:
         # Creates a new offline user data job.
-        offline_user_data_job = ga_client.get_type("OfflineUserDataJob")
-        offline_user_data_job.type_ = (
-            ga_client.enums.OfflineUserDataJobTypeEnum.CUSTOMER_MATCH_USER_LIST
-        )
-        offline_user_data_job.customer_match_user_list_metadata.user_list = (
-            user_list_resource_name
-        )
-        # Issues a request to create an offline user data job.
-        create_offline_user_data_job_response = offline_user_data_job_service_client.create_offline_user_data_job(
-            customer_id=customer_id, job=offline_user_data_job
-        )
-        offline_user_data_job_resource_name = (
-            create_offline_user_data_job_response.resource_name
-        )
-        print(
-            "Created an offline user data job with resource name: "
-            f"'{offline_user_data_job_resource_name}'."
+        offline_user_data_job_resource_name = create_offline_user_data_job(
+            ga_client, customer_id, user_list_resource_name
         )
 
-    # Issues a request to add the operations to the offline user data job.
-
-    # Best Practice: This example only adds a few operations, so it only sends
-    # one AddOfflineUserDataJobOperations request. If your application is adding
-    # a large number of operations, split the operations into batches and send
-    # multiple AddOfflineUserDataJobOperations requests for the SAME job. See
+    # Best Practice: Large uploads are split into batches and sent as multiple
+    # AddOfflineUserDataJobOperations requests for the SAME job. See
     # https://developers.google.com/google-ads/api/docs/remarketing/audience-types/customer-match#customer_match_considerations
     # and https://developers.google.com/google-ads/api/docs/best-practices/quotas#user_data
     # for more information on the per-request limits.
-    operations = []
-    if replace:
-        # Note that when a remove_all operation is included, it must be the first operation in a job. If not, then
-        # running the job will return an INVALID_OPERATION_ORDER error.
-        operation = ga_client.get_type("OfflineUserDataJobOperation")
-        operation.remove_all = True
-        operations.append(operation)
-
-    operations.extend(build_offline_user_data_job_operations(ga_client, records))
-
-    request = ga_client.get_type("AddOfflineUserDataJobOperationsRequest")
-    request.resource_name = offline_user_data_job_resource_name
-    request.operations = operations
-    request.enable_partial_failure = True
-
-    # Issues a request to add the operations to the offline user data job.
-    response = offline_user_data_job_service_client.add_offline_user_data_job_operations(
-        request=request
-    )
-
-    # Prints the status message if any partial failure error is returned.
-    # Note: the details of each partial failure error are not printed here.
-    # Refer to the error_handling/handle_partial_failure.py example to learn
-    # more.
-    # Extracts the partial failure from the response status.
-    partial_failure = getattr(response, "partial_failure_error", None)
-    if getattr(partial_failure, "code", None) != 0:
-        error_details = getattr(partial_failure, "details", [])
-        for error_detail in error_details:
-            failure_message = ga_client.get_type("GoogleAdsFailure")
-            # Retrieve the class definition of the GoogleAdsFailure instance
-            # in order to use the "deserialize" class method to parse the
-            # error_detail string into a protobuf message object.
-            failure_object = type(failure_message).deserialize(
-                error_detail.value
+    # Note that when a remove_all operation is included, it must be the first operation in a job. If not, then
+    # running the job will return an INVALID_OPERATION_ORDER error. The uploader
+    # only adds it to the first request. A delta upload never replaces the list.
+    delta = False
+    if snapshot is not None:
+        # The snapshot of the previous upload only counts once its job succeeded.
+        snapshot.resolve_pending(ga_client)
+        if snapshot.exists():
+            user_list = get_user_lists(ga_client, [user_list_resource_name]).get(user_list_resource_name)
+            membership_life_span = (
+                user_list.membership_life_span if user_list is not None else USER_LIST_MEMBERSHIP_LIFE_SPAN
             )
-
-            for error in failure_object.errors:
+            delta = not snapshot.is_expired(membership_life_span)
+            if not delta:
                 print(
-                    "A partial failure at index "
-                    f"{error.location.field_path_elements[0].index} occurred.\n"
-                    f"Error message: {error.message}\n"
-                    f"Error code: {error.error_code}"
+                    "Uploading every member again, as their membership may expire "
+                    f"within {DELTA_REFRESH_MARGIN_DAYS} days."
                 )
+    skip_row = None
+    if checkpoint is not None:
+        checkpoint.start(offline_user_data_job_resource_name, user_list_resource_name)
+        if checkpoint.acknowledged_rows:
+            print(
+                f"Resuming offline user data job '{offline_user_data_job_resource_name}': "
+                f"{checkpoint.acknowledged_rows} rows were already acknowledged."
+            )
+            skip_row = checkpoint.is_acknowledged
+    uploader = OfflineUserDataJobOperationUploader(
+        ga_client,
+        offline_user_data_job_resource_name,
+        # A resumed job already holds the remove_all operation.
+        remove_all=replace and not delta and not (checkpoint and checkpoint.remove_all_acknowledged),
+        max_operations_per_request=max_operations_per_request,
+        max_request_bytes=max_request_bytes,
+        max_requests_in_flight=max_requests_in_flight,
+        on_acknowledged=checkpoint.acknowledge if checkpoint is not None else None,
+        on_partial_failure=failure_report.add if failure_report is not None else None,
+        metrics=metrics,
+        rate_limiter=rate_limiter,
+    )
+    # Only a bounded number of batches of operations is held in memory at a
+    # time, so the memory used does not grow with the size of the user list.
+    if record_batches is None:
+        record_batches = RecordBatch.iter_from_records(records)
+    operations = iter_record_batch_operations(
+        ga_client,
+        record_batches,
+        hash_executor=hash_executor,
+        skip_row=skip_row,
+        pre_hashed_columns=pre_hashed_columns,
+        metrics=metrics,
+    )
+    if deduplicate:
+        deduplicator = UserDataDeduplicator()
+        operations = deduplicator.filter(ga_client, operations)
+    uploaded = False
+    try:
+        if snapshot is not None:
+            delta_counts = add_user_list_delta_operations(
+                ga_client, uploader, operations, snapshot, baseline=delta
+            )
+        else:
+            for row_number, operation in operations:
+                uploader.add(operation, row_number)
+        uploader.close()
+        uploaded = True
+    finally:
+        uploader.shutdown()
+        if checkpoint is not None:
+            # Records the last acknowledged batches, even if the upload failed,
+            # so that a retry can resume from them.
+            checkpoint.save()
+        if failure_report is not None and not uploaded:
+            # The job does not run, so the failures are reported now.
+            failure_report.save()
+
+    if snapshot is not None:
+        print(
+            f"Delta upload: {delta_counts['added']} users added, "
+            f"{delta_counts['removed']} removed and {delta_counts['unchanged']} unchanged."
+        )
 
-    print("The operations are added to the offline user data job.")
+    if deduplicate:
+        print(f"{deduplicator.duplicates} duplicate users were dropped.")
+    print(
+        f"{uploader.operations_sent} operations are added to the offline user data job "
+        f"in {uploader.requests_sent} requests."
+    )
+    if stats is not None:
+        if deduplicate:
+            stats["duplicates_dropped"] = deduplicator.duplicates
+        stats["operations_sent"] = uploader.operations_sent
+        stats["requests_sent"] = uploader.requests_sent
+        stats["retries"] = uploader.retries
+        if snapshot is not None:
+            stats["delta"] = delta_counts
 
     if not run_job:
         print(
             "Not running offline user data job "
             f"'{offline_user_data_job_resource_name}', as requested."
         )
+        if snapshot is not None:
+            # The job may never run, so the snapshot cannot be relied on.
+            print("The user list snapshot is not updated, as the job is not run.")
+            snapshot.discard()
+        if failure_report is not None:
+            failure_report.save()
         return None
 
     # Issues a request to run the offline user data job for executing all
     # added operations.
-    offline_user_data_job_service_client.run_offline_user_data_job(
-        resource_name=offline_user_data_job_resource_name
-    )
+    # Quota errors are retried.
+    try:
+        with metrics.stage("run"):
+            call_with_retries(
+                lambda: offline_user_data_job_service_client.run_offline_user_data_job(
+                    resource_name=offline_user_data_job_resource_name
+                ),
+                rate_limiter,
+            )
+    finally:
+        # Writing to the bucket is only attempted once the job was run, and
+        # never raises.
+        if failure_report is not None:
+            failure_report.save()
+    if checkpoint is not None:
+        # The job is running, so it can no longer be resumed.
+        checkpoint.delete()
+    if snapshot is not None:
+        if uploader.partial_failures:
+            # Rejected members are not in the user list, so the next delta
+            # upload starts again from the previous snapshot.
+            print(
+                f"The user list snapshot is not updated, as {uploader.partial_failures} "
+                "operations were rejected."
+            )
+            snapshot.discard()
+        else:
+            # The new members become the baseline of the next delta upload
+            # once the job succeeds.
+            snapshot.set_pending_job(offline_user_data_job_resource_name, full_upload=not delta)
 
-    # Retrieves and displays the job status.
-    return check_job_status(ga_client, customer_id, offline_user_data_job_resource_name)
+    if not check_status:
+        return offline_user_data_job_resource_name
 
+    # Retrieves and displays the job status.
+    with metrics.stage("check_status"):
+        return check_job_status(ga_client, customer_id, offline_user_data_job_resource_name)
 
-def build_offline_user_data_job_operations(ga_client, raw_records):
-    """Creates a raw input list of unhashed user information.
 
+def add_users_to_partitioned_customer_match_user_lists(
+    ga_client,
+    customer_id,
+    user_list_resource_names,
+    partition_column,
+    record_batches,
+    separator=None,
+    replace=True,
+    max_operations_per_request=MAX_OPERATIONS_PER_REQUEST,
+    max_request_bytes=MAX_REQUEST_BYTES,
+    max_requests_in_flight=MAX_REQUESTS_IN_FLIGHT,
+    hash_executor=None,
+    pre_hashed_columns=(),
+    deduplicate=True,
+    check_status=True,
+    failure_reports=None,
+    stats=None,
+    metrics=None,
+    rate_limiter=None,
+):
+    """Uses Customer Match to add the users of one source to several user lists.
+    The records are read and hashed once. Each record is routed by the value
+    of its partition column to zero or more user lists, and each user list is
+    fed by its own uploader, to its own offline user data job, from that
+    single pass.
     Args:
         ga_client: The Google Ads client.
-
+        customer_id: The ID for the customer that owns the user lists.
+        user_list_resource_names: Dict mapping each value of the partition
+            column to the list of resource names of the user lists to which
+            the records with that value are added.
+        partition_column: The name of the column which routes the records.
+        record_batches: Iterable of RecordBatch holding the partition column.
+        separator: Optional string which separates several values in a cell
+            of the partition column, routing the record to the user lists of
+            each value.
+        replace: If true, replaces the existing members of each user list.
+        max_operations_per_request: Maximum number of operations sent in a
+            single AddOfflineUserDataJobOperations request.
+        max_request_bytes: Maximum serialized size of the operations sent in a
+            single AddOfflineUserDataJobOperations request.
+        max_requests_in_flight: Maximum number of
+            AddOfflineUserDataJobOperations requests sent concurrently for each
+            user list.
+        hash_executor: Optional process pool used to normalize and hash the
+            identifiers.
+        pre_hashed_columns: Names of the columns of HASHED_COLUMNS whose
+            values are already SHA-256 hex digests.
+        deduplicate: If true, only the first record of users that have the
+            same hashed identifiers is uploaded to each user list.
+        check_status: If true, retrieves the status of the jobs once they run.
+            Otherwise, returns as soon as the jobs are submitted.
+        failure_reports: Optional dict mapping user list resource names to the
+            PartialFailureReport of their job.
+        stats: Optional dict which is filled with the number of
+            "rows_unrouted", whose partition value matches no user list.
+        metrics: Optional UploadMetrics which records the time spent in each
+            stage of the upload.
+        rate_limiter: Optional RateLimiter of the requests that upload the
+            operations and run the jobs. Defaults to the one of the customer.
     Returns:
-        A list containing the operations.
+        A dict mapping each user list resource name to a dict with its
+        offline user data "job", or its resource name if check_status is
+        False or the job failed to run, and the "operations_sent",
+        "requests_sent", "retries" and, if deduplicating, "duplicates_dropped"
+        of its upload. If the job failed to run, the dict also holds the
+        "error" status.
     """
+    metrics = metrics or UploadMetrics()
+    rate_limiter = rate_limiter or get_rate_limiter(customer_id)
+    failure_reports = failure_reports or {}
+    offline_user_data_job_service_client = get_service(
+        ga_client, "OfflineUserDataJobService"
+    )
+    targets = list(dict.fromkeys(
+        resource_name
+        for resource_names in user_list_resource_names.values()
+        for resource_name in resource_names
+    ))
+
+    # Each user list gets its own job; the remove_all operation, if any, is
+    # the first operation of each job.
+    job_resource_names = {}
+    uploaders = {}
+    deduplicators = {}
+    uploaded = False
+    try:
+        for user_list_resource_name in targets:
+            job_resource_names[user_list_resource_name] = create_offline_user_data_job(
+                ga_client, customer_id, user_list_resource_name
+            )
+            failure_report = failure_reports.get(user_list_resource_name)
+            uploaders[user_list_resource_name] = OfflineUserDataJobOperationUploader(
+                ga_client,
+                job_resource_names[user_list_resource_name],
+                remove_all=replace,
+                max_operations_per_request=max_operations_per_request,
+                max_request_bytes=max_request_bytes,
+                max_requests_in_flight=max_requests_in_flight,
+                on_partial_failure=failure_report.add if failure_report is not None else None,
+                metrics=metrics,
+                rate_limiter=rate_limiter,
+            )
+            if deduplicate:
+                deduplicators[user_list_resource_name] = UserDataDeduplicator()
+
+        operations = iter_record_batch_operations(
+            ga_client,
+            record_batches,
+            hash_executor=hash_executor,
+            pre_hashed_columns=pre_hashed_columns,
+            metrics=metrics,
+            partition_column=partition_column,
+        )
+        user_data_type = type(ga_client.get_type("UserData"))
+        # The user lists of each distinct cell of the partition column.
+        routes = {}
+        rows_unrouted = 0
+        for row_number, operation, key in operations:
+            user_lists = routes.get(key)
+            if user_lists is None:
+                # Cells are stripped the same way with or without a separator.
+                if key is None:
+                    values = [key]
+                elif separator is None:
+                    values = [key.strip()]
+                else:
+                    values = [value.strip() for value in key.split(separator)]
+                user_lists = routes[key] = list(dict.fromkeys(
+                    resource_name
+                    for value in values
+                    for resource_name in user_list_resource_names.get(value, ())
+                ))
+            if not user_lists:
+                rows_unrouted += 1
+                continue
+            # The user is serialized once for all of its user lists.
+            serialized = user_data_type.serialize(operation.create) if deduplicate else None
+            for user_list_resource_name in user_lists:
+                if deduplicate and not deduplicators[user_list_resource_name].add(serialized):
+                    continue
+                uploaders[user_list_resource_name].add(operation, row_number)
+        for uploader in uploaders.values():
+            uploader.close()
+        uploaded = True
+    finally:
+        for uploader in uploaders.values():
+            uploader.shutdown()
+        if not uploaded:
+            # The jobs do not run, so the failures are reported now.
+            for failure_report in failure_reports.values():
+                failure_report.save()
+
+    if stats is not None:
+        stats["rows_unrouted"] = rows_unrouted
+    print(f"{rows_unrouted} rows matched no user list.")
+
+    results = {}
+    for user_list_resource_name in targets:
+        uploader = uploaders[user_list_resource_name]
+        offline_user_data_job_resource_name = job_resource_names[user_list_resource_name]
+        print(
+            f"{uploader.operations_sent} operations are added to the offline user data job "
+            f"'{offline_user_data_job_resource_name}' in {uploader.requests_sent} requests."
+        )
+        result = {
+            "job": offline_user_data_job_resource_name,
+            "operations_sent": uploader.operations_sent,
+            "requests_sent": uploader.requests_sent,
+            "retries": uploader.retries,
+        }
+        if deduplicate:
+            result["duplicates_dropped"] = deduplicators[user_list_resource_name].duplicates
+        results[user_list_resource_name] = result
+        # Issues a request to run the offline user data job for executing all
+        # added operations. Quota errors are retried. A job that fails to run
+        # does not stop the jobs of the other user lists.
+        try:
+            with metrics.stage("run"):
+                call_with_retries(
+                    lambda: offline_user_data_job_service_client.run_offline_user_data_job(
+                        resource_name=offline_user_data_job_resource_name
+                    ),
+                    rate_limiter,
+                )
+        except (GoogleAdsException, grpc.RpcError) as ex:
+            result["error"] = _status_code_name(ex) or "UNKNOWN"
+            print(
+                f"Failed to run the offline user data job '{offline_user_data_job_resource_name}' "
+                f"with status '{result['error']}': {ex}"
+            )
+        finally:
+            if user_list_resource_name in failure_reports:
+                failure_reports[user_list_resource_name].save()
+
+    if check_status:
+        # Retrieves and displays the status of every job once all of them run,
+        # with one query for the jobs and one for the user lists they filled.
+        with metrics.stage("check_status"):
+            jobs = get_offline_user_data_jobs(
+                ga_client, [result["job"] for result in results.values() if "error" not in result]
+            )
+            user_lists = get_user_lists(
+                ga_client,
+                [
+                    user_list_resource_name
+                    for user_list_resource_name, result in results.items()
+                    if result["job"] in jobs and jobs[result["job"]].status.name == "SUCCESS"
+                ],
+            )
+            for user_list_resource_name, result in results.items():
+                if "error" in result:
+                    continue
+                offline_user_data_job = jobs.get(result["job"])
+                if offline_user_data_job is None:
+                    print(f"Offline user data job '{result['job']}' was not found.")
+                    continue
+                status_name = offline_user_data_job.status.name
+                print(
+                    f"Offline user data job ID '{offline_user_data_job.id}' with type "
+                    f"'{offline_user_data_job.type_.name}' has status: {status_name}"
+                )
+                user_list = user_lists.get(user_list_resource_name)
+                if user_list is not None:
+                    print(
+                        "The estimated number of users that the user list "
+                        f"'{user_list.resource_name}' has is "
+                        f"{user_list.size_for_display} for Display and "
+                        f"{user_list.size_for_search} for Search."
+                    )
+                elif status_name == "FAILED":
+                    print(f"\tFailure Reason: {offline_user_data_job.failure_reason}")
+                result["job"] = offline_user_data_job
+    return results
 
-    operations = []
-    # Iterates over the raw input list and creates a UserData object for each
-    # record.
-    for record in raw_records:
-        # Creates a UserData object that represents a member of the user list.
-        user_data = ga_client.get_type("UserData")
 
+def iter_record_batch_operations(
+    ga_client,
+    record_batches,
+    hash_executor=None,
+    skip_row=None,
+    pre_hashed_columns=(),
+    metrics=None,
+    partition_column=None,
+):
+    """Lazily creates an operation for each record of a stream of RecordBatch.
+    The identifier columns of each batch are normalized and hashed together
+    before the operations of the batch are created.
+
+    Args:
+        ga_client: The Google Ads client.
+        record_batches: Iterable of RecordBatch.
+        hash_executor: Optional process pool used to normalize and hash the
+            identifiers.
+        skip_row: Optional function called with the row number of each record.
+            Records for which it returns True are skipped before hashing.
+        pre_hashed_columns: Names of the columns of HASHED_COLUMNS whose
+            values are already SHA-256 hex digests. They are validated and
+            used without being normalized or hashed.
+        metrics: Optional UploadMetrics which records the time spent reading,
+            hashing and building the operations of each batch.
+        partition_column: Optional name of a column of the batches. If given,
+            the value of this column for the record is yielded as well.
+
+    Yields:
+        A tuple of the row number of the record and its operation, in the order
+        of the records, followed by the value of the partition column if one is
+        given.
+    """
+    metrics = metrics or UploadMetrics()
+    for batch in metrics.iter_stage("parse", record_batches):
+        metrics.add("parse", rows=len(batch))
+        if skip_row is not None:
+            batch = batch.select(
+                [index for index, row_number in enumerate(batch.row_numbers) if not skip_row(row_number)]
+            )
+        with metrics.stage("hash", rows=len(batch)):
+            hashed_columns = _hash_identifier_columns(batch, hash_executor, pre_hashed_columns)
+        # The operations of a batch are built together, so that building them
+        # is timed once per batch rather than once per operation.
+        with metrics.stage("build", rows=len(batch)):
+            operations = list(_build_operations_for_batch(ga_client, batch, hashed_columns))
+        row_numbers = batch.row_numbers
+        if partition_column is not None:
+            keys = batch.columns[partition_column]
+            for index, operation in operations:
+                yield row_numbers[index], operation, keys[index]
+            continue
+        for index, operation in operations:
+            yield row_numbers[index], operation
+
+
+def _build_operations_for_batch(ga_client, batch, hashed_columns):
+    """Creates the operations for a RecordBatch.
+    Args:
+        ga_client: The Google Ads client.
+        batch: The RecordBatch.
+        hashed_columns: The hashed identifiers of the batch, as returned by
+            _hash_identifier_columns.
+    Yields:
+        A tuple of the index of the record and its operation, in the order of
+        the records.
+    """
+    hashed_emails = hashed_columns["Email"]
+    hashed_phones = hashed_columns["Phone"]
+    hashed_first_names = hashed_columns["First name"]
+    hashed_last_names = hashed_columns["Last name"]
+    first_names = batch.columns["First name"]
+    countries = batch.columns["Country"]
+    zips = batch.columns["Zip"]
+    required_keys = ("Last name", "Country", "Zip")
+    # The message classes are resolved once, rather than with get_type for
+    # every record and identifier.
+    builder = get_operation_builder(ga_client)
+
+    # Iterates over the records and creates a UserData object for each one.
+    for index in range(len(batch)):
         # Checks if the record has email, phone, or address information, and
         # adds a SEPARATE UserIdentifier object for each one found. For example,
         # a record with an email address and a phone number will result in a
@@ -304,90 +1442,1453 @@ def build_offline_user_data_job_operations(ga_client, raw_records):
         # incorrect_user_identifier.hashed_email = "..."
         # incorrect_user_identifier.hashed_phone_number = "..."
 
-        # The separate 'if' statements below demonstrate the correct approach
-        # for creating a UserData object for a member with multiple
+        # OfflineUserDataJobOperationBuilder.build demonstrates the correct
+        # approach for creating a UserData object for a member with multiple
         # UserIdentifiers.
 
-        # Checks if the record has an email address, and if so, adds a
-        # UserIdentifier for it.
-        if "Email" in record:
-            user_identifier = ga_client.get_type("UserIdentifier")
-            user_identifier.hashed_email = normalize_and_hash(
-                record["Email"], True
-            )
-            # Adds the hashed email identifier to the UserData object's list.
-            user_data.user_identifiers.append(user_identifier)
-
-        # Checks if the record has a phone number, and if so, adds a
-        # UserIdentifier for it.
-        if "Phone" in record:
-            user_identifier = ga_client.get_type("UserIdentifier")
-            user_identifier.hashed_phone_number = normalize_and_hash(
-                record["Phone"], True
-            )
-            # Adds the hashed phone number identifier to the UserData object's
-            # list.
-            user_data.user_identifiers.append(user_identifier)
-
         # Checks if the record has all the required mailing address elements,
-        # and if so, adds a UserIdentifier for the mailing address.
-        if "First name" in record:
-            required_keys = ("Last name", "Country", "Zip")
-            # Checks if the record contains all the other required elements of
-            # a mailing address.
-            if not all(key in record for key in required_keys):
+        # and if so, adds a UserIdentifier for the mailing address. The names
+        # were only hashed when all of them are present.
+        address = None
+        if first_names[index] is not None:
+            if hashed_first_names[index] is None or hashed_last_names[index] is None:
                 # Determines which required elements are missing from the
-                # record.
-                missing_keys = record.keys() - required_keys
-                print(
-                    "Skipping addition of mailing address information "
-                    "because the following required keys are missing: "
-                    f"{missing_keys}"
-                )
+                # record. If none is missing, a pre-hashed name was invalid.
+                missing_keys = {
+                    key for key in required_keys if batch.columns[key][index] is None
+                }
+                if missing_keys:
+                    print(
+                        "Skipping addition of mailing address information "
+                        "because the following required keys are missing: "
+                        f"{missing_keys}"
+                    )
             else:
-                user_identifier = ga_client.get_type("UserIdentifier")
-                address_info = user_identifier.address_info
-                address_info.hashed_first_name = normalize_and_hash(
-                    record["First name"], False
+                address = (
+                    hashed_first_names[index],
+                    hashed_last_names[index],
+                    countries[index],
+                    zips[index],
                 )
-                address_info.hashed_last_name = normalize_and_hash(
-                    record["Last name"], False
+
+        # Only records with at least one identifier produce an operation.
+        operation = builder.build(hashed_emails[index], hashed_phones[index], address)
+        if operation is not None:
+            yield index, operation
+
+
+def _hash_identifier_columns(batch, hash_executor, pre_hashed_columns=()):
+    """Normalizes and hashes the identifier columns of a RecordBatch.
+    Args:
+        batch: The RecordBatch.
+        hash_executor: Optional process pool used to normalize and hash the
+            identifiers.
+        pre_hashed_columns: Names of the columns already holding digests.
+            Their values are only validated.
+    Returns:
+        A dict mapping "Email", "Phone", "First name" and "Last name" to a list
+        with the hashed value of that column for each record, or None where the
+        record has no value to hash. Names are only hashed for records that
+        have a complete mailing address.
+    """
+    columns = batch.columns
+    address_columns = [columns[key] for key in ("First name", "Last name", "Country", "Zip")]
+    has_address = [
+        all(column[index] is not None for column in address_columns)
+        for index in range(len(batch))
+    ]
+    positions_by_column = {
+        "Email": [index for index, value in enumerate(columns["Email"]) if value is not None],
+        "Phone": [index for index, value in enumerate(columns["Phone"]) if value is not None],
+        "First name": [index for index in range(len(batch)) if has_address[index]],
+    }
+    positions_by_column["Last name"] = positions_by_column["First name"]
+
+    hashed_columns = {}
+    for column, remove_all_whitespace in (
+        ("Email", True),
+        ("Phone", True),
+        ("First name", False),
+        ("Last name", False),
+    ):
+        positions = positions_by_column[column]
+        values = columns[column]
+        if column in pre_hashed_columns:
+            hashed_columns[column] = _validate_pre_hashed_column(column, values, positions, len(batch))
+            continue
+        digests = normalize_and_hash_many(
+            [values[index] for index in positions],
+            remove_all_whitespace,
+            executor=hash_executor,
+        )
+        hashed = [None] * len(batch)
+        for index, digest in zip(positions, digests):
+            hashed[index] = digest
+        hashed_columns[column] = hashed
+
+    return hashed_columns
+
+
+def _validate_pre_hashed_column(column, values, positions, size):
+    """Checks the values of a pre-hashed column.
+    Only the length and characters of the values are checked. Invalid values
+    are dropped, as if the records had no value.
+    Args:
+        column: The name of the column.
+        values: The values of the column.
+        positions: The indices of the values to use.
+        size: The number of records of the batch.
+    Returns:
+        A list with the lowercase digest of each record, or None.
+    """
+    hashed = [None] * size
+    invalid = 0
+    fullmatch = _SHA256_HEX_PATTERN.fullmatch
+    for index in positions:
+        digest = values[index].strip().lower()
+        if fullmatch(digest):
+            hashed[index] = digest
+        else:
+            invalid += 1
+    if invalid:
+        print(f"Skipping {invalid} values of the column '{column}' which are not SHA-256 hex digests.")
+    return hashed
+
+
+class OfflineUserDataJobOperationBuilder:
+    """Builds the create operations of the members of a user list.
+    The classes of the raw protobuf messages are resolved once, and each
+    operation is built as a raw message and only wrapped in its proto-plus
+    class once complete, which avoids a get_type call and the proto-plus
+    marshalling for every identifier. The operations serialize exactly like
+    the ones built field by field through proto-plus.
+    """
+
+    def __init__(self, ga_client):
+        """Resolves the message classes of a Google Ads client.
+        Args:
+            ga_client: The Google Ads client.
+        """
+        self._operation_type = type(ga_client.get_type("OfflineUserDataJobOperation"))
+        self._operation_pb = self._operation_type.pb()
+        self._address_info_pb = type(ga_client.get_type("OfflineUserAddressInfo")).pb()
+
+    def build(self, hashed_email=None, hashed_phone_number=None, address=None):
+        """Builds the create operation of a member of the user list.
+        Args:
+            hashed_email: The hashed email address, or None.
+            hashed_phone_number: The hashed phone number, or None.
+            address: A tuple of the hashed first name, the hashed last name,
+                the country code and the postal code, or None.
+        Returns:
+            The OfflineUserDataJobOperation, or None if there is no identifier.
+        """
+        if hashed_email is None and hashed_phone_number is None and address is None:
+            return None
+        operation = self._operation_pb()
+        user_identifiers = operation.create.user_identifiers
+        # The identifier of a UserIdentifier is a oneof, so each identifier is
+        # added as a SEPARATE UserIdentifier.
+        if hashed_email is not None:
+            user_identifiers.add(hashed_email=hashed_email)
+        if hashed_phone_number is not None:
+            user_identifiers.add(hashed_phone_number=hashed_phone_number)
+        if address is not None:
+            hashed_first_name, hashed_last_name, country_code, postal_code = address
+            user_identifiers.add(
+                address_info=self._address_info_pb(
+                    hashed_first_name=hashed_first_name,
+                    hashed_last_name=hashed_last_name,
+                    country_code=country_code,
+                    postal_code=postal_code,
                 )
-                address_info.country_code = record["Country"]
-                address_info.postal_code = record["Zip"]
-                user_data.user_identifiers.append(user_identifier)
+            )
+        return self._operation_type.wrap(operation)
 
-        # If the user_identifiers repeated field is not empty, create a new
-        # OfflineUserDataJobOperation and add the UserData to it.
-        if user_data.user_identifiers:
-            operation = ga_client.get_type("OfflineUserDataJobOperation")
-            operation.create = user_data
-            operations.append(operation)
 
-    return operations
+def get_operation_builder(ga_client):
+    """Returns the OfflineUserDataJobOperationBuilder of a Google Ads client.
+    Args:
+        ga_client: The Google Ads client.
+    Returns:
+        An OfflineUserDataJobOperationBuilder, created on first use.
+    """
+    with _clients_lock:
+        builder = _operation_builders.get(ga_client)
+        if builder is None:
+            builder = _operation_builders[ga_client] = OfflineUserDataJobOperationBuilder(ga_client)
+        return builder
+
+
+class RecordBatch:
+    """Columns of a batch of records of the user list.
+    Only the columns in USER_LIST_COLUMNS, and any extra column read for
+    partitioning, are kept. Each column is a list with a string for every
+    record, or None where the record has no value.
+    """
 
+    def __init__(self, columns, row_numbers, column_names=USER_LIST_COLUMNS):
+        """Initializes the batch.
+        Args:
+            columns: Dict mapping column names to lists of values. Missing
+                columns are filled with None.
+            row_numbers: Sequence with the row number of each record.
+            column_names: The names of the columns kept.
+        """
+        self.row_numbers = row_numbers
+        self.columns = {
+            name: columns.get(name) or [None] * len(row_numbers)
+            for name in column_names
+        }
+
+    def __len__(self):
+        return len(self.row_numbers)
+
+    def select(self, indices):
+        """Returns a RecordBatch with the records at the given indices."""
+        if len(indices) == len(self):
+            return self
+        return RecordBatch(
+            {name: [column[index] for index in indices] for name, column in self.columns.items()},
+            [self.row_numbers[index] for index in indices],
+            column_names=tuple(self.columns),
+        )
 
-def normalize_and_hash(s, remove_all_whitespace):
-    """Normalizes and hashes a string with SHA-256.
+    def iter_records(self):
+        """Yields each record as a dict of the columns it has a value for."""
+        for index in range(len(self)):
+            yield {
+                name: column[index]
+                for name, column in self.columns.items()
+                if column[index] is not None
+            }
+
+    @classmethod
+    def iter_from_records(cls, records, batch_size=RECORDS_CHUNK_SIZE):
+        """Groups dict records into batches.
+        Args:
+            records: Iterable of dicts.
+            batch_size: Maximum number of records in a batch.
+        Yields:
+            RecordBatch objects, numbering the records from 0.
+        """
+        records = iter(records)
+        row_number = 0
+        while True:
+            chunk = list(itertools.islice(records, batch_size))
+            if not chunk:
+                return
+            yield cls(
+                {name: [record.get(name) for record in chunk] for name in USER_LIST_COLUMNS},
+                range(row_number, row_number + len(chunk)),
+            )
+            row_number += len(chunk)
+
+
+class UserListSnapshot:
+    """Snapshot of the members of a user list as of its last successful upload.
+    The snapshot is a gzip compressed blob with one line per member, holding
+    the base64 encoded serialized UserData. It only contains hashed
+    identifiers. A new snapshot is first written to a pending blob. Once the
+    job which uploads it is run, the job is recorded in the state blob of the
+    snapshot, and the pending snapshot only replaces the current one when a
+    later upload sees that job succeed. The state also records when the
+    members were last all uploaded, so that they can be uploaded again before
+    their membership expires.
+    """
+
+    def __init__(self, bucket, customer_id, user_list_id):
+        """Initializes the snapshot.
+        Args:
+            bucket: The cloud storage bucket holding the snapshot.
+            customer_id: The ID for the customer that owns the user list.
+            user_list_id: The ID of the user list.
+        """
+        self.bucket = bucket
+        self.blob_name = f"{USER_LIST_SNAPSHOT_PREFIX}{customer_id}/{user_list_id}.gz"
+        self.pending_blob_name = f"{self.blob_name}.pending"
+        self.state_blob_name = f"{USER_LIST_SNAPSHOT_PREFIX}{customer_id}/{user_list_id}.json"
+
+    def exists(self):
+        """Returns True if a previous upload left a snapshot."""
+        return self.bucket.blob(self.blob_name).exists()
+
+    def _load_state(self):
+        """Returns the state of the snapshot, empty if there is none."""
+        blob = self.bucket.blob(self.state_blob_name)
+        if not blob.exists():
+            return {}
+        return json.loads(blob.download_as_bytes())
+
+    def _save_state(self, state):
+        self.bucket.blob(self.state_blob_name).upload_from_string(
+            json.dumps(state), content_type="application/json"
+        )
+
+    def is_expired(self, membership_life_span):
+        """Returns True if the members of the snapshot may have left the user
+        list, as their last full upload is about to reach the membership life
+        span of the list.
+        Args:
+            membership_life_span: The membership life span of the user list, in
+                days. USER_LIST_UNLIMITED_LIFE_SPAN never expires.
+        """
+        if membership_life_span >= USER_LIST_UNLIMITED_LIFE_SPAN:
+            return False
+        uploaded = self._load_state().get("full_upload_time")
+        if uploaded is None:
+            return True
+        max_age_days = membership_life_span - DELTA_REFRESH_MARGIN_DAYS
+        return time.time() - uploaded > max_age_days * 24 * 60 * 60
+
+    def iter_members(self, pending=False):
+        """Reads the serialized UserData of the members in the snapshot.
+        Args:
+            pending: If true, reads the pending snapshot instead.
+        Yields:
+            The serialized UserData of each member.
+        """
+        blob = self.bucket.blob(self.pending_blob_name if pending else self.blob_name)
+        with blob.open("rb", chunk_size=GCS_CHUNK_SIZE) as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode="rb") as file:
+                for line in file:
+                    yield base64.b64decode(line)
+
+    def open_pending(self):
+        """Opens the pending snapshot for writing.
+        Returns:
+            A binary file object; write_member writes a member to it.
+        """
+        return self.bucket.blob(self.pending_blob_name).open("wb")
+
+    @staticmethod
+    def write_member(file, serialized_user_data):
+        """Writes the serialized UserData of a member to a snapshot file."""
+        file.write(base64.b64encode(serialized_user_data) + b"\n")
+
+    def set_pending_job(self, offline_user_data_job_resource_name, full_upload):
+        """Records the job which uploads the pending snapshot.
+        Args:
+            offline_user_data_job_resource_name: The resource name of the job.
+            full_upload: True if the job uploads every member, rather than the
+                difference with the current snapshot.
+        """
+        state = self._load_state()
+        state["pending"] = {
+            "job": offline_user_data_job_resource_name,
+            "full_upload": full_upload,
+            "time": time.time(),
+        }
+        self._save_state(state)
+
+    def resolve_pending(self, ga_client):
+        """Settles the pending snapshot left by the previous upload.
+        The pending snapshot replaces the current one if its job succeeded.
+        It is discarded if the job failed, or has not finished yet: the next
+        upload is then compared with the current snapshot, so that it sends
+        again the changes the job may not apply.
+        Args:
+            ga_client: The Google Ads client.
+        """
+        state = self._load_state()
+        pending = state.get("pending")
+        if pending is None:
+            return
+        job = get_offline_user_data_jobs(ga_client, [pending["job"]]).get(pending["job"])
+        status_name = job.status.name if job is not None else "NOT_FOUND"
+        if status_name == "SUCCESS":
+            self.commit()
+            if pending["full_upload"]:
+                state["full_upload_time"] = pending["time"]
+            print(f"The user list snapshot of job '{pending['job']}' is now the baseline.")
+        else:
+            self.discard()
+            print(
+                f"The user list snapshot of job '{pending['job']}' is discarded, "
+                f"as the job has status {status_name}."
+            )
+        del state["pending"]
+        self._save_state(state)
+
+    def commit(self):
+        """Replaces the snapshot with the pending snapshot."""
+        pending_blob = self.bucket.blob(self.pending_blob_name)
+        self.bucket.copy_blob(pending_blob, self.bucket, self.blob_name)
+        pending_blob.delete()
+
+    def discard(self):
+        """Deletes the pending snapshot, keeping the current one."""
+        pending_blob = self.bucket.blob(self.pending_blob_name)
+        if pending_blob.exists():
+            pending_blob.delete()
+
+
+def add_user_list_delta_operations(ga_client, uploader, operations, snapshot, baseline=True):
+    """Adds the operations which turn the snapshot into the new members.
+    Members are compared on a 64-bit fingerprint of their serialized UserData,
+    kept in sorted arrays, so memory grows by 16 bytes per member rather than
+    with the size of the members. The new members are written to the pending
+    snapshot on the first pass, so their identifiers are only hashed once.
+    Users that were dropped are removed before new users are created, so that
+    a user whose identifiers changed is not removed after being re-added.
     Args:
-        s: The string to perform this operation on.
-        remove_all_whitespace: If true, removes leading, trailing, and
-            intermediate spaces from the string before hashing. If false, only
-            removes leading and trailing spaces from the string before hashing.
+        ga_client: The Google Ads client.
+        uploader: The OfflineUserDataJobOperationUploader of the job.
+        operations: Iterable of tuples of a row number and a create operation
+            for the new members.
+        snapshot: The UserListSnapshot of the user list.
+        baseline: If false, the current snapshot is ignored and every member
+            is added.
     Returns:
-        A normalized (lowercase, remove whitespace) and SHA-256 hashed string.
+        A dict with the number of users "added", "removed" and "unchanged".
     """
-    # Normalizes by first converting all characters to lowercase, then trimming
-    # spaces.
-    if remove_all_whitespace:
-        # Removes leading, trailing, and intermediate whitespace.
-        s = "".join(s.split())
-    else:
-        # Removes only leading and trailing spaces.
-        s = s.strip().lower()
+    user_data_type = type(ga_client.get_type("UserData"))
+    operation_type = type(ga_client.get_type("OfflineUserDataJobOperation"))
+
+    previous = array("Q")
+    if baseline and snapshot.exists():
+        previous = _sorted_fingerprints(
+            _fingerprint(member) for member in snapshot.iter_members()
+        )
+
+    def write_pending_snapshot():
+        with snapshot.open_pending() as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode="wb") as file:
+                for _, operation in operations:
+                    serialized = user_data_type.serialize(operation.create)
+                    snapshot.write_member(file, serialized)
+                    yield _fingerprint(serialized)
+
+    current = _sorted_fingerprints(write_pending_snapshot())
+
+    counts = {"added": 0, "removed": 0, "unchanged": 0}
+    if previous:
+        for member in snapshot.iter_members():
+            if not _contains(current, _fingerprint(member)):
+                operation = operation_type()
+                operation.remove = user_data_type.deserialize(member)
+                uploader.add(operation)
+                counts["removed"] += 1
+
+    for member in snapshot.iter_members(pending=True):
+        if _contains(previous, _fingerprint(member)):
+            counts["unchanged"] += 1
+        else:
+            operation = operation_type()
+            operation.create = user_data_type.deserialize(member)
+            uploader.add(operation)
+            counts["added"] += 1
+
+    return counts
+
+
+class UserDataDeduplicator:
+    """Drops create operations for users that were already seen.
+    Users are identified by their serialized UserData, which only holds their
+    hashed identifiers. Up to exact_max_entries distinct users are tracked in
+    a set of the serialized messages; past that, the set is replaced by a
+    FingerprintSet of 64-bit fingerprints, which needs about 16 bytes per
+    user at the cost of a negligible chance of dropping a distinct user.
+    """
+
+    def __init__(self, exact_max_entries=DEDUP_EXACT_MAX_ENTRIES):
+        """Initializes the deduplicator.
+        Args:
+            exact_max_entries: Number of users tracked exactly before switching
+                to fingerprints.
+        """
+        self.exact_max_entries = exact_max_entries
+        self.duplicates = 0
+        self._seen = set()
+        self._fingerprints = None
+
+    def add(self, serialized_user_data):
+        """Records a user.
+        Args:
+            serialized_user_data: The serialized UserData of the user.
+        Returns:
+            True if the user was not seen before.
+        """
+        if self._fingerprints is not None:
+            is_new = self._fingerprints.add(_fingerprint(serialized_user_data))
+        elif serialized_user_data in self._seen:
+            is_new = False
+        else:
+            self._seen.add(serialized_user_data)
+            is_new = True
+            if len(self._seen) > self.exact_max_entries:
+                self._fingerprints = FingerprintSet(2 * len(self._seen))
+                for seen in self._seen:
+                    self._fingerprints.add(_fingerprint(seen))
+                self._seen = None
+        if not is_new:
+            self.duplicates += 1
+        return is_new
+
+    def filter(self, ga_client, numbered_operations):
+        """Filters duplicate users out of a stream of create operations.
+        Args:
+            ga_client: The Google Ads client.
+            numbered_operations: Iterable of tuples of a row number and a
+                create operation.
+        Yields:
+            The tuples of users that were not seen before, in order.
+        """
+        user_data_type = type(ga_client.get_type("UserData"))
+        for row_number, operation in numbered_operations:
+            if self.add(user_data_type.serialize(operation.create)):
+                yield row_number, operation
+
+
+class FingerprintSet:
+    """Set of 64-bit fingerprints stored in an open-addressing hash table
+    backed by an array, which needs far less memory than a Python set.
+    """
+
+    def __init__(self, capacity=1024):
+        """Initializes an empty set.
+        Args:
+            capacity: Number of fingerprints the set can hold before it grows.
+        """
+        size = 1
+        while size < 2 * capacity:
+            size *= 2
+        self._table = array("Q", bytes(8 * size))
+        self._mask = size - 1
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def add(self, fingerprint):
+        """Adds a fingerprint.
+        Args:
+            fingerprint: An unsigned 64-bit integer.
+        Returns:
+            True if the fingerprint was not in the set.
+        """
+        # 0 marks an empty slot, so it is stored as 1.
+        fingerprint = fingerprint or 1
+        table = self._table
+        mask = self._mask
+        index = fingerprint & mask
+        while True:
+            slot = table[index]
+            if slot == fingerprint:
+                return False
+            if slot == 0:
+                break
+            index = (index + 1) & mask
+        table[index] = fingerprint
+        self._length += 1
+        # Keeps the table at most half full so that probe sequences stay short.
+        if 2 * self._length > len(table):
+            self._grow()
+        return True
+
+    def _grow(self):
+        """Doubles the size of the table."""
+        old_table = self._table
+        self._table = array("Q", bytes(16 * len(old_table)))
+        self._mask = len(self._table) - 1
+        self._length = 0
+        for fingerprint in old_table:
+            if fingerprint:
+                self.add(fingerprint)
+
+
+def _fingerprint(serialized_user_data):
+    """Returns a 64-bit fingerprint of a serialized UserData."""
+    return int.from_bytes(
+        hashlib.blake2b(serialized_user_data, digest_size=8).digest(), "little"
+    )
+
+
+def _sorted_fingerprints(fingerprints, run_size=1000000):
+    """Sorts fingerprints into an array without building a list of all of them.
+    Runs of run_size fingerprints are sorted separately and then merged.
+    Args:
+        fingerprints: Iterable of 64-bit fingerprints.
+        run_size: Number of fingerprints sorted at a time.
+    Returns:
+        A sorted array of unsigned 64-bit integers.
+    """
+    fingerprints = iter(fingerprints)
+    runs = []
+    while True:
+        run = sorted(itertools.islice(fingerprints, run_size))
+        if not run:
+            break
+        runs.append(array("Q", run))
+    if len(runs) == 1:
+        return runs[0]
+    return array("Q", heapq.merge(*runs))
+
+
+def _contains(sorted_values, value):
+    """Returns True if value is in the sorted array."""
+    index = bisect.bisect_left(sorted_values, value)
+    return index < len(sorted_values) and sorted_values[index] == value
+
+
+class UploadCheckpoint:
+    """Record of the source rows whose operations an offline user data job
+    acknowledged, stored as a JSON blob next to the input blob.
+    There is one checkpoint per input blob, customer and user list, so that
+    the uploads of a blob to several user lists do not overwrite each other.
+    The rows are kept as a sorted list of disjoint, inclusive [first, last]
+    ranges. The checkpoint is written to cloud storage at most once every
+    interval seconds while the upload runs, and when it ends. The remove_all
+    operation is recorded right away, as it must not be sent twice.
+    """
+
+    def __init__(self, bucket, blob_name, customer_id, user_list_id, interval=CHECKPOINT_INTERVAL_SECONDS):
+        """Loads the checkpoint of an input blob, if there is one.
+        Args:
+            bucket: The cloud storage bucket holding the input blob.
+            blob_name: The name of the input blob.
+            customer_id: The ID for the customer that owns the user list.
+            user_list_id: The ID of the user list.
+            interval: Minimum number of seconds between two writes.
+        """
+        self._blob = bucket.blob(f"{blob_name}.{customer_id}.{user_list_id}.checkpoint.json")
+        self.interval = interval
+        self._lock = threading.Lock()
+        # Serializes writes, so that an older state never overwrites a newer one.
+        self._save_lock = threading.Lock()
+        self._last_saved = 0
+        self._data = None
+        if self._blob.exists():
+            self._data = json.loads(self._blob.download_as_bytes())
+
+    def job_id(self, user_list_resource_name):
+        """Returns the ID of the checkpointed job, if it adds users to the user list.
+        Args:
+            user_list_resource_name: The resource name of the user list.
+        Returns:
+            The job ID as a string, or None.
+        """
+        if self._data is None or self._data["user_list"] != user_list_resource_name:
+            return None
+        return self._data["job"].rsplit("/", 1)[-1]
+
+    def start(self, offline_user_data_job_resource_name, user_list_resource_name):
+        """Starts recording an upload to a job.
+        The acknowledged rows are kept if the checkpoint belongs to the same
+        job and user list, and cleared otherwise.
+        Args:
+            offline_user_data_job_resource_name: The resource name of the job.
+            user_list_resource_name: The resource name of the user list.
+        """
+        with self._lock:
+            if self._data is None or (
+                self._data["job"], self._data["user_list"]
+            ) != (offline_user_data_job_resource_name, user_list_resource_name):
+                self._data = {
+                    "job": offline_user_data_job_resource_name,
+                    "user_list": user_list_resource_name,
+                    "remove_all": False,
+                    "rows": [],
+                }
+        # Saves the job right away, so that a retry finds it even if the upload
+        # is interrupted before the first batch is acknowledged.
+        self.save()
+
+    @property
+    def remove_all_acknowledged(self):
+        """True if the job acknowledged the remove_all operation."""
+        return bool(self._data and self._data["remove_all"])
+
+    @property
+    def acknowledged_rows(self):
+        """The number of rows that were acknowledged."""
+        if self._data is None:
+            return 0
+        return sum(last - first + 1 for first, last in self._data["rows"])
+
+    def is_acknowledged(self, row_number):
+        """Returns True if the row was acknowledged."""
+        rows = self._data["rows"]
+        index = bisect.bisect_right(rows, [row_number, float("inf")]) - 1
+        return index >= 0 and rows[index][0] <= row_number <= rows[index][1]
+
+    def acknowledge(self, first_row, last_row, remove_all=False):
+        """Records an acknowledged request. Safe to call from several threads.
+        Args:
+            first_row: The first row number covered by the request, or None.
+            last_row: The last row number covered by the request, or None.
+            remove_all: True if the request held the remove_all operation.
+        """
+        with self._lock:
+            if remove_all:
+                self._data["remove_all"] = True
+            if first_row is not None:
+                rows = self._data["rows"]
+                bisect.insort(rows, [first_row, last_row])
+                # Merges ranges that overlap or touch.
+                merged = [rows[0]]
+                for first, last in rows[1:]:
+                    if first <= merged[-1][1] + 1:
+                        merged[-1][1] = max(merged[-1][1], last)
+                    else:
+                        merged.append([first, last])
+                self._data["rows"] = merged
+            # A resumed upload that sent the remove_all operation again would
+            # fail, so its acknowledgement is saved right away.
+            save = remove_all or time.monotonic() - self._last_saved >= self.interval
+        if save:
+            self.save()
+
+    def save(self):
+        """Writes the checkpoint to cloud storage."""
+        with self._save_lock:
+            with self._lock:
+                if self._data is None:
+                    return
+                data = json.dumps(self._data)
+                self._last_saved = time.monotonic()
+            self._blob.upload_from_string(data, content_type="application/json")
+
+    def delete(self):
+        """Deletes the checkpoint from cloud storage."""
+        with self._lock:
+            self._data = None
+        if self._blob.exists():
+            self._blob.delete()
+
+
+class UploadMetrics:
+    """Wall time, rows, bytes and memory of each stage of an upload.
+    Stages nest: the time of a stage excludes the time of the stages entered
+    while it runs on the same thread, so that the stages of a streaming
+    pipeline can be told apart. Stages that run on several threads, such as
+    "upload", add up the time of every thread. The memory of a stage is the
+    highest resident memory of this process when the stage starts or ends,
+    sampled from /proc/self/statm, so that it is not hidden by the peak of an
+    earlier invocation on a warm instance; worker processes are not included.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Maps a stage to its [seconds, calls, rows, bytes, max RSS].
+        self._stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=0, num_bytes=0):
+        """Times the block as the given stage. Safe to use from several threads.
+        Args:
+            name: The name of the stage.
+            rows: The number of rows processed by the block.
+            num_bytes: The number of bytes processed by the block.
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        # Accumulates the time of the nested stages.
+        stack.append(0.0)
+        start_rss = _current_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.add(name, elapsed - nested, rows, num_bytes, calls=1, rss=max(start_rss, _current_rss_bytes()))
+
+    def iter_stage(self, name, iterable):
+        """Yields the items of an iterable, timing the production of each one
+        as the given stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name, seconds=0.0, rows=0, num_bytes=0, calls=0, rss=0):
+        """Adds to the counters of a stage. Safe to call from several threads."""
+        with self._lock:
+            counters = self._stages.setdefault(name, [0.0, 0, 0, 0, 0])
+            counters[0] += seconds
+            counters[1] += calls
+            counters[2] += rows
+            counters[3] += num_bytes
+            counters[4] = max(counters[4], rss)
+
+    def summary(self):
+        """Returns the metrics as a dict that can be serialized as JSON."""
+        with self._lock:
+            stages = {name: list(counters) for name, counters in self._stages.items()}
+        summary = {
+            "wall_seconds": round(time.perf_counter() - self._start, 6),
+            # The peak over the life of the process, which includes the
+            # invocations served before this one.
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "stages": {},
+        }
+        for name, (seconds, calls, rows, num_bytes, max_rss) in stages.items():
+            summary["stages"][name] = {
+                "seconds": round(seconds, 6),
+                "calls": calls,
+                "rows": rows,
+                "rows_per_second": round(rows / seconds, 1) if rows and seconds else None,
+                "bytes": num_bytes,
+                "max_rss_bytes": max_rss,
+            }
+        return summary
+
+    def log(self):
+        """Prints one structured log line per stage, which Cloud Logging
+        parses as a JSON payload.
+        """
+        summary = self.summary()
+        for name, stage in summary["stages"].items():
+            print(json.dumps({"severity": "INFO", "message": f"Upload stage '{name}'", "stage": name, **stage}))
+        print(
+            json.dumps(
+                {
+                    "severity": "INFO",
+                    "message": "Upload metrics",
+                    "wall_seconds": summary["wall_seconds"],
+                    "peak_rss_bytes": summary["peak_rss_bytes"],
+                }
+            )
+        )
+
+
+def _current_rss_bytes():
+    """Returns the resident memory of this process, in bytes, or 0 where
+    /proc/self/statm is not available.
+    """
+    try:
+        with open("/proc/self/statm", "rb") as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def run_profiled(function, *args):
+    """Calls a function under cProfile and writes the profile to PROFILE_DIR.
+    Only the calling thread is profiled.
+    Args:
+        function: The function to call.
+        args: The arguments of the function.
+    Returns:
+        A tuple of the result of the function and the path of the profile,
+        which can be read with the pstats module.
+    """
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(function, *args)
+    finally:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(
+            PROFILE_DIR,
+            f"upload-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{threading.get_ident()}.prof",
+        )
+        profiler.dump_stats(path)
+        print(f"Profile written to '{path}'.")
+    return result, path
+
+
+class PartialFailureReport:
+    """Operations rejected by an offline user data job, mapped back to the
+    source rows of the input blob and stored as an NDJSON blob next to it.
+    There is one report per input blob, customer and user list. Each failure
+    is kept as a tuple; the report is sorted by request and operation, and
+    written once the job runs, or once the upload fails.
+    """
+
+    def __init__(self, bucket, blob_name, customer_id, user_list_id):
+        """Initializes an empty report for an upload of an input blob.
+        Args:
+            bucket: The cloud storage bucket holding the input blob.
+            blob_name: The name of the input blob.
+            customer_id: The ID for the customer that owns the user list.
+            user_list_id: The ID of the user list.
+        """
+        self._blob = bucket.blob(f"{blob_name}.{customer_id}.{user_list_id}.failures.ndjson")
+        self._lock = threading.Lock()
+        self._failures = []
+        self._saved = False
+
+    @property
+    def blob_name(self):
+        """The name of the report blob."""
+        return self._blob.name
+
+    def add(self, row_number, batch_index, index, operation, error):
+        """Records a rejected operation. Safe to call from several threads.
+        Args:
+            row_number: The source row number of the operation, or None.
+            batch_index: The position of the request within the upload.
+            index: The position of the operation within the request, or None.
+            operation: The OfflineUserDataJobOperation, or None.
+            error: The GoogleAdsError.
+        """
+        error_code = type(error.error_code).pb(error.error_code)
+        code_field = error_code.WhichOneof("error_code")
+        code = None
+        if code_field is not None:
+            code = f"{code_field}.{getattr(error.error_code, code_field).name}"
+        kind = None
+        if operation is not None:
+            kind = type(operation).pb(operation).WhichOneof("operation")
+        with self._lock:
+            self._failures.append((batch_index, index, row_number, kind, code, error.message))
+
+    def summary(self):
+        """Returns the number of failures, by error code, and the report blob."""
+        with self._lock:
+            error_codes = {}
+            for failure in self._failures:
+                error_codes[failure[4]] = error_codes.get(failure[4], 0) + 1
+            return {
+                "count": len(self._failures),
+                "error_codes": error_codes,
+                "blob_name": self.blob_name if self._failures and self._saved else None,
+            }
+
+    def save(self):
+        """Writes the report to cloud storage, one failure per line.
+        A report left by a previous upload of the input blob is deleted when
+        there is no failure. Storage errors, such as a missing permission to
+        create objects in the bucket, are logged rather than raised, so that
+        the report never fails the upload it describes.
+        """
+        with self._lock:
+            failures = sorted(self._failures, key=lambda failure: (failure[0], failure[1] or 0))
+        try:
+            if not failures:
+                if self._blob.exists():
+                    self._blob.delete()
+                return
+            with self._blob.open("w", content_type="application/x-ndjson") as file:
+                for batch_index, index, row_number, kind, code, message in failures:
+                    file.write(
+                        json.dumps(
+                            {
+                                "row": row_number,
+                                "batch": batch_index,
+                                "index": index,
+                                "operation": kind,
+                                "error_code": code,
+                                "message": message,
+                            }
+                        )
+                        + "\n"
+                    )
+        except (GoogleAPIError, OSError) as e:
+            print(f"Failed to write the partial failure report '{self.blob_name}': {e}")
+            return
+        self._saved = True
+        print(f"{len(failures)} partial failures are reported in '{self.blob_name}'.")
+
+
+class OfflineUserDataJobOperationUploader:
+    """Sends operations to an offline user data job in bounded batches.
+    Operations are buffered until adding another one would exceed either the
+    maximum number of operations or the maximum serialized size of a single
+    AddOfflineUserDataJobOperations request; the buffer is then sent to the
+    job and cleared.
+    Up to max_requests_in_flight requests are sent concurrently from a thread
+    pool; adding operations blocks while that many requests are outstanding.
+    The request holding the remove_all operation is always sent, and
+    acknowledged, before any other request.
+    """
+
+    # Allowance for the request envelope (resource name and flags) and the
+    # per-operation field tag and length prefix.
+    _REQUEST_OVERHEAD_BYTES = 1024
+    _OPERATION_OVERHEAD_BYTES = 6
+
+    def __init__(
+        self,
+        ga_client,
+        offline_user_data_job_resource_name,
+        remove_all=False,
+        max_operations_per_request=MAX_OPERATIONS_PER_REQUEST,
+        max_request_bytes=MAX_REQUEST_BYTES,
+        max_requests_in_flight=MAX_REQUESTS_IN_FLIGHT,
+        on_acknowledged=None,
+        on_partial_failure=None,
+        metrics=None,
+        rate_limiter=None,
+    ):
+        """Initializes the uploader.
+        Args:
+            ga_client: The Google Ads client.
+            offline_user_data_job_resource_name: The resource name of the
+                offline user data job to which the operations are added.
+            remove_all: If true, the first request starts with a remove_all
+                operation, which replaces the existing members of the user list.
+            max_operations_per_request: Maximum number of operations in a
+                single request.
+            max_request_bytes: Maximum serialized size of a single request.
+            max_requests_in_flight: Maximum number of requests sent
+                concurrently. If 1, requests are sent one after another.
+            on_acknowledged: Optional function called, possibly from another
+                thread, once a request is acknowledged. It is passed the first
+                and last source row numbers covered by the request, or None for
+                both when its operations have no row numbers, and whether the
+                request held the remove_all operation.
+            on_partial_failure: Optional function called, possibly from another
+                thread, for each operation the job rejected. It is passed the
+                source row number of the operation, or None, the position of
+                the request and of the operation within it, the operation, and
+                the GoogleAdsError.
+            metrics: Optional UploadMetrics which records the time spent
+                sending requests, as the "upload" stage, and waiting for
+                requests in flight, as the "upload_wait" stage.
+            rate_limiter: Optional RateLimiter which spaces the requests.
+                Requests that fail with a quota error are retried
+                with backoff, whether or not there is a rate limiter.
+        """
+        if max_operations_per_request < 1:
+            raise ValueError("max_operations_per_request must be at least 1")
+        if max_requests_in_flight < 1:
+            raise ValueError("max_requests_in_flight must be at least 1")
+        self._ga_client = ga_client
+        self._service = get_service(ga_client, "OfflineUserDataJobService")
+        self._operation_type = type(ga_client.get_type("OfflineUserDataJobOperation"))
+        self.resource_name = offline_user_data_job_resource_name
+        self.max_operations_per_request = max_operations_per_request
+        self.max_request_bytes = max_request_bytes
+        self.max_requests_in_flight = max_requests_in_flight
+        self.requests_sent = 0
+        self.operations_sent = 0
+        self.retries = 0
+        self.partial_failures = 0
+        self._rate_limiter = rate_limiter
+        self._on_acknowledged = on_acknowledged
+        self._on_partial_failure = on_partial_failure
+        self._metrics = metrics or UploadMetrics()
+        self._batch = []
+        # The source row number of each buffered operation, or None.
+        self._batch_rows = []
+        self._batch_bytes = self._REQUEST_OVERHEAD_BYTES
+        self._batch_last_row = None
+        # A batch covers the rows from the end of the previous batch, so that
+        # rows which produced no operation are covered as well.
+        self._next_first_row = 0
+        self._batches_started = 0
+        # The first request must be acknowledged before any other is sent
+        # when it carries the remove_all operation.
+        self._send_next_synchronously = remove_all
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._executor = None
+        if max_requests_in_flight > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_requests_in_flight,
+                thread_name_prefix="offline-user-data-job-upload",
+            )
+
+        if remove_all:
+            operation = self._operation_type()
+            operation.remove_all = True
+            self.add(operation)
+
+    def add(self, operation, row_number=None):
+        """Adds an operation, sending the buffered batch first if it is full.
+        Args:
+            operation: The OfflineUserDataJobOperation to add.
+            row_number: Optional row number of the source record of the
+                operation. Row numbers must be added in increasing order.
+        """
+        operation_bytes = (
+            self._operation_type.pb(operation).ByteSize()
+            + self._OPERATION_OVERHEAD_BYTES
+        )
+        if self._batch and (
+            len(self._batch) >= self.max_operations_per_request
+            or self._batch_bytes + operation_bytes > self.max_request_bytes
+        ):
+            self.flush()
+        self._batch.append(operation)
+        self._batch_rows.append(row_number)
+        self._batch_bytes += operation_bytes
+        if row_number is not None:
+            self._batch_last_row = row_number
+
+    def flush(self):
+        """Sends the buffered operations, if any, in a single request."""
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        batch_rows, self._batch_rows = self._batch_rows, []
+        batch_bytes = self._batch_bytes
+        self._batch_bytes = self._REQUEST_OVERHEAD_BYTES
+        batch_index = self._batches_started
+        self._batches_started += 1
+        rows = (None, None)
+        if self._batch_last_row is not None:
+            rows = (self._next_first_row, self._batch_last_row)
+            self._next_first_row = self._batch_last_row + 1
+            self._batch_last_row = None
+
+        if self._executor is None or self._send_next_synchronously:
+            self._send_next_synchronously = False
+            self._send(batch, batch_index, rows, batch_rows, batch_bytes)
+            return
+
+        # Blocks until a slot is free, which bounds both the number of
+        # concurrent requests and the number of batches held in memory.
+        with self._metrics.stage("upload_wait"):
+            self._wait_for_in_flight(self.max_requests_in_flight - 1)
+        self._in_flight.add(
+            self._executor.submit(self._send, batch, batch_index, rows, batch_rows, batch_bytes)
+        )
+
+    def close(self):
+        """Sends any operations that are still buffered and waits for every
+        outstanding request to be acknowledged.
+        Raises:
+            The first exception raised by any of the outstanding requests.
+        """
+        self.flush()
+        with self._metrics.stage("upload_wait"):
+            self._wait_for_in_flight(0)
+
+    def shutdown(self):
+        """Cancels requests that have not started and releases the threads."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _wait_for_in_flight(self, limit):
+        """Waits until at most limit requests are outstanding.
+        Args:
+            limit: The number of outstanding requests to wait for.
+        Raises:
+            The exception raised by a request that failed.
+        """
+        while len(self._in_flight) > limit:
+            done, self._in_flight = wait(self._in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+    def _count_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def _send(self, operations, batch_index, rows, operation_rows, request_bytes):
+        """Issues an AddOfflineUserDataJobOperations request for a batch.
+        Args:
+            operations: The operations to send.
+            batch_index: The position of the batch within the upload.
+            rows: Tuple of the first and last source row numbers covered by
+                the batch.
+            operation_rows: The source row number of each operation, or None.
+            request_bytes: The estimated serialized size of the request.
+        """
+        ga_client = self._ga_client
+        request = ga_client.get_type("AddOfflineUserDataJobOperationsRequest")
+        request.resource_name = self.resource_name
+        request.operations = operations
+        request.enable_partial_failure = True
+
+        # Issues a request to add the operations to the offline user data job.
+        with self._metrics.stage("upload", rows=len(operations), num_bytes=request_bytes):
+            response = call_with_retries(
+                lambda: self._service.add_offline_user_data_job_operations(
+                    request=request
+                ),
+                self._rate_limiter,
+                on_retry=self._count_retry,
+            )
+        with self._lock:
+            self.requests_sent += 1
+            self.operations_sent += len(operations)
+        if self._on_acknowledged is not None:
+            self._on_acknowledged(rows[0], rows[1], bool(operations[0].remove_all))
+
+        # Reports the operations rejected by the job, if any partial failure
+        # error is returned. Refer to the error_handling/handle_partial_failure.py
+        # example to learn more.
+        # Extracts the partial failure from the response status.
+        partial_failure = getattr(response, "partial_failure_error", None)
+        if getattr(partial_failure, "code", None) != 0:
+            error_details = getattr(partial_failure, "details", [])
+            failures = 0
+            for error_detail in error_details:
+                failure_message = ga_client.get_type("GoogleAdsFailure")
+                # Retrieve the class definition of the GoogleAdsFailure instance
+                # in order to use the "deserialize" class method to parse the
+                # error_detail string into a protobuf message object.
+                failure_object = type(failure_message).deserialize(
+                    error_detail.value
+                )
+
+                for error in failure_object.errors:
+                    failures += 1
+                    if self._on_partial_failure is None:
+                        continue
+                    # The first field path element is the index of the
+                    # operation within the request.
+                    elements = error.location.field_path_elements
+                    index = elements[0].index if elements else None
+                    operation = None
+                    row_number = None
+                    if index is not None and 0 <= index < len(operations):
+                        operation = operations[index]
+                        row_number = operation_rows[index]
+                    self._on_partial_failure(row_number, batch_index, index, operation, error)
+            if failures:
+                with self._lock:
+                    self.partial_failures += failures
+                print(f"{failures} partial failures occurred in batch {batch_index}.")
+
+
+class RateLimiter:
+    """Token bucket which spaces the requests sent for a customer.
+    Its rate tunes itself to the quota of the customer: it grows by a fixed
+    step after each successful request, and is cut by a factor when the API
+    throttles the customer (additive increase, multiplicative decrease).
+    """
+
+    def __init__(
+        self,
+        rate=RATE_LIMIT_INITIAL_RATE,
+        min_rate=RATE_LIMIT_MIN_RATE,
+        max_rate=RATE_LIMIT_MAX_RATE,
+        burst=RATE_LIMIT_BURST,
+        increase=RATE_LIMIT_INCREASE,
+        decrease_factor=RATE_LIMIT_DECREASE_FACTOR,
+        decrease_interval=1.0,
+    ):
+        """Initializes a full bucket.
+        Args:
+            rate: Initial number of requests per second.
+            min_rate: Lowest rate after throttling.
+            max_rate: Highest rate reached by successful requests.
+            burst: Number of requests that can be sent at once after an idle
+                period.
+            increase: Requests per second added after a successful request.
+            decrease_factor: Factor applied to the rate when throttled.
+            decrease_interval: Seconds after lowering the rate during which
+                throttling does not lower it again, so that requests that were
+                in flight together only count once.
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self._decreased = None
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent. Safe to call from several threads."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def on_success(self):
+        """Raises the rate after a successful request."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttled(self):
+        """Lowers the rate, and empties the bucket, after a throttled request.
+        Returns:
+            The new rate.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._decreased is None or now - self._decreased >= self.decrease_interval:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self._decreased = now
+            self._tokens = min(self._tokens, 0.0)
+            return self.rate
+
+
+def get_rate_limiter(customer_id):
+    """Returns the RateLimiter of a customer, creating it on first use.
+    Args:
+        customer_id: The ID of the customer.
+    Returns:
+        A RateLimiter shared by the invocations served by this instance.
+    """
+    with _rate_limiters_lock:
+        rate_limiter = _rate_limiters.get(str(customer_id))
+        if rate_limiter is None:
+            rate_limiter = _rate_limiters[str(customer_id)] = RateLimiter()
+        return rate_limiter
+
+
+def call_with_retries(
+    function,
+    rate_limiter=None,
+    max_attempts=RETRY_MAX_ATTEMPTS,
+    initial_delay=RETRY_INITIAL_DELAY_SECONDS,
+    max_delay=RETRY_MAX_DELAY_SECONDS,
+    on_retry=None,
+):
+    """Calls a Google Ads API method, retrying quota errors.
+    Retries wait for a random delay of up to initial_delay seconds, doubled
+    at each attempt and capped at max_delay, or for the retry delay requested
+    by the API if it is longer. Errors whose requested retry delay exceeds
+    max_delay, such as an exhausted daily quota, are not retried.
+    Args:
+        function: The function which calls the method, without arguments.
+        rate_limiter: Optional RateLimiter acquired before each attempt, and
+            told about successes and throttling.
+        max_attempts: Maximum number of calls.
+        initial_delay: Maximum delay before the first retry, in seconds.
+        max_delay: Maximum delay between two attempts, in seconds.
+        on_retry: Optional function called before each retry.
+    Returns:
+        The result of the function.
+    Raises:
+        GoogleAdsException or grpc.RpcError: If the error is not retryable or
+            the last attempt failed.
+    """
+    for attempt in itertools.count(1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            result = function()
+        except (GoogleAdsException, grpc.RpcError) as ex:
+            status = _status_code_name(ex)
+            if status not in RETRYABLE_STATUS_CODES or attempt >= max_attempts:
+                raise
+            delay = random.uniform(0, min(max_delay, initial_delay * 2 ** (attempt - 1)))
+            if status == "RESOURCE_EXHAUSTED":
+                retry_delay = _retry_delay_seconds(ex)
+                if retry_delay is not None:
+                    if retry_delay > max_delay:
+                        raise
+                    delay = max(delay, retry_delay)
+                if rate_limiter is not None:
+                    rate = rate_limiter.on_throttled()
+                    print(f"Throttled by the Google Ads API, lowering the request rate to {rate:.2f}/s.")
+            print(f"Retrying after {status} in {delay:.1f} s (attempt {attempt} of {max_attempts}).")
+            if on_retry is not None:
+                on_retry()
+            time.sleep(delay)
+        else:
+            if rate_limiter is not None:
+                rate_limiter.on_success()
+            return result
+
+
+def _status_code_name(exception):
+    """Returns the name of the gRPC status code of an API error, or None."""
+    error = exception.error if isinstance(exception, GoogleAdsException) else exception
+    code = getattr(error, "code", None)
+    if not callable(code):
+        return None
+    status_code = code()
+    return getattr(status_code, "name", None)
 
-    # Hashes the normalized string using the hashing algorithm.
-    return hashlib.sha256(s.encode()).hexdigest()
+
+def _retry_delay_seconds(exception):
+    """Returns the longest retry delay requested by the quota errors of a
+    GoogleAdsException, in seconds, or None.
+    """
+    if not isinstance(exception, GoogleAdsException):
+        return None
+    delays = []
+    for error in exception.failure.errors:
+        details = type(error).pb(error).details
+        if details.HasField("quota_error_details"):
+            delays.append(details.quota_error_details.retry_delay.ToTimedelta().total_seconds())
+    return max(delays, default=None)
+
+
+def normalize_and_hash_many(values, remove_all_whitespace, executor=None, task_size=HASH_TASK_SIZE):
+    """Normalizes and hashes many strings with SHA-256.
+    The output is identical to calling normalize_and_hash on each value. When
+    an executor is given, the values are split into tasks of task_size values
+    that are hashed by its worker processes.
+    Args:
+        values: Sequence of strings to perform this operation on.
+        remove_all_whitespace: Passed to normalize_and_hash for every value.
+        executor: Optional concurrent.futures.Executor.
+        task_size: Number of values hashed in a single task.
+    Returns:
+        A list of the hashed strings, in the order of the values.
+    """
+    if executor is None or len(values) <= task_size:
+        return normalize_and_hash_task(values, remove_all_whitespace)
+
+    tasks = [values[start:start + task_size] for start in range(0, len(values), task_size)]
+    # Executor.map returns the results in the order of the tasks.
+    results = executor.map(
+        normalize_and_hash_task, tasks, itertools.repeat(remove_all_whitespace)
+    )
+    return list(itertools.chain.from_iterable(results))
+
+
+def get_hash_executor(processes=HASH_PROCESSES):
+    """Returns an executor which normalizes and hashes identifiers in worker
+    processes.
+    A single pool of HASH_PROCESSES workers is created on first use and
+    shared by the invocations served by the same instance; asking for fewer
+    processes limits the number of tasks run at a time in that pool. Workers
+    are spawned rather than forked, because forking a process that holds gRPC
+    channels and upload threads is not safe.
+    Args:
+        processes: Number of worker processes, capped at HASH_PROCESSES.
+    Returns:
+        An executor with a map method, or None if processes is 1 or less.
+    """
+    global _hash_executor
+    processes = min(processes, HASH_PROCESSES)
+    if processes <= 1:
+        return None
+    with _hash_executor_lock:
+        if _hash_executor is None:
+            _hash_executor = ProcessPoolExecutor(
+                max_workers=HASH_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        executor = _hash_executor
+    if processes < HASH_PROCESSES:
+        return _LimitedExecutor(executor, processes)
+    return executor
+
+
+class _LimitedExecutor:
+    """View of an executor which runs at most max_workers of its tasks at a
+    time.
+    """
+
+    def __init__(self, executor, max_workers):
+        self._executor = executor
+        self.max_workers = max_workers
+
+    def map(self, function, *iterables):
+        """Like Executor.map, but submits a task only when fewer than
+        max_workers of the previous ones are running.
+        Returns:
+            A list of the results, in the order of the arguments.
+        """
+        futures = []
+        for arguments in zip(*iterables):
+            if len(futures) >= self.max_workers:
+                futures[len(futures) - self.max_workers].result()
+            futures.append(self._executor.submit(function, *arguments))
+        return [future.result() for future in futures]
 
 
 def check_job_status(ga_client, customer_id, offline_user_data_job_resource_name):
@@ -419,7 +2920,7 @@ def check_job_status(ga_client, customer_id, offline_user_data_job_resource_name
         LIMIT 1"""
 
     # Issues a search request using streaming.
-    google_ads_service = ga_client.get_service("GoogleAdsService")
+    google_ads_service = get_service(ga_client, "GoogleAdsService")
     results = google_ads_service.search(customer_id=customer_id, query=query)
     offline_user_data_job = next(iter(results)).offline_user_data_job
     status_name = offline_user_data_job.status.name
@@ -447,6 +2948,97 @@ def check_job_status(ga_client, customer_id, offline_user_data_job_resource_name
     return offline_user_data_job
 
 
+def get_offline_user_data_jobs(ga_client, offline_user_data_job_resource_names):
+    """Retrieves many offline user data jobs, possibly of several customers.
+    Args:
+        ga_client: The Google Ads client.
+        offline_user_data_job_resource_names: The resource names of the offline
+            user data jobs.
+    Returns:
+        A dict mapping the resource name of each job that was found to the
+        offline user data job.
+    """
+    rows = search_resources(
+        ga_client,
+        "offline_user_data_job",
+        [
+            "offline_user_data_job.resource_name",
+            "offline_user_data_job.id",
+            "offline_user_data_job.status",
+            "offline_user_data_job.type",
+            "offline_user_data_job.failure_reason",
+            "offline_user_data_job.customer_match_user_list_metadata.user_list",
+        ],
+        offline_user_data_job_resource_names,
+    )
+    return {
+        row.offline_user_data_job.resource_name: row.offline_user_data_job
+        for row in rows
+    }
+
+
+def get_user_lists(ga_client, user_list_resource_names):
+    """Retrieves many user lists, possibly of several customers.
+    Args:
+        ga_client: The Google Ads client.
+        user_list_resource_names: The resource names of the user lists.
+    Returns:
+        A dict mapping the resource name of each user list that was found to
+        the user list.
+    """
+    rows = search_resources(
+        ga_client,
+        "user_list",
+        [
+            "user_list.resource_name",
+            "user_list.id",
+            "user_list.name",
+            "user_list.size_for_display",
+            "user_list.size_for_search",
+            "user_list.membership_life_span",
+        ],
+        user_list_resource_names,
+    )
+    return {row.user_list.resource_name: row.user_list for row in rows}
+
+
+def search_resources(ga_client, resource, fields, resource_names, max_names_per_query=GAQL_MAX_IN_VALUES):
+    """Retrieves many resources of one type with as few queries as possible.
+    The resource names are grouped by customer, and each group is retrieved
+    with queries filtering on up to max_names_per_query resource names. The
+    results are streamed with GoogleAdsService.SearchStream.
+    Args:
+        ga_client: The Google Ads client.
+        resource: The resource to select from, for example "user_list".
+        fields: The fields to select.
+        resource_names: The resource names of the resources to retrieve.
+        max_names_per_query: Maximum number of resource names in a query.
+    Yields:
+        The GoogleAdsRow of each resource that was found.
+    """
+    resource_names_by_customer = {}
+    for resource_name in dict.fromkeys(resource_names):
+        customer_id = resource_name.split("/")[1]
+        resource_names_by_customer.setdefault(customer_id, []).append(resource_name)
+
+    google_ads_service = get_service(ga_client, "GoogleAdsService")
+    for customer_id, customer_resource_names in resource_names_by_customer.items():
+        for start in range(0, len(customer_resource_names), max_names_per_query):
+            names = ", ".join(
+                f"'{resource_name}'"
+                for resource_name in customer_resource_names[start:start + max_names_per_query]
+            )
+            query = f"""
+                SELECT {", ".join(fields)}
+                FROM {resource}
+                WHERE {resource}.resource_name IN ({names})"""
+
+            # Issues a search request using streaming.
+            stream = google_ads_service.search_stream(customer_id=customer_id, query=query)
+            for batch in stream:
+                yield from batch.results
+
+
 def print_customer_match_user_list_info(ga_client, customer_id, user_list_resource_name):
     """Prints information about the Customer Match user list.
     Args:
@@ -455,7 +3047,7 @@ def print_customer_match_user_list_info(ga_client, customer_id, user_list_resour
         user_list_resource_name: The resource name of the user list to which to
             add users.
     """
-    googleads_service_client = ga_client.get_service("GoogleAdsService")
+    googleads_service_client = get_service(ga_client, "GoogleAdsService")
 
     # Creates a query that retrieves the user list.
     query = f"""
@@ -484,27 +3076,249 @@ def print_customer_match_user_list_info(ga_client, customer_id, user_list_resour
     )
 
 
-def get_file_from_gcs(blob_name, bucket_name):
-    """Get the user list from cloud storage.
+class MalformedFileError(ValueError):
+    """Raised when a user list blob cannot be parsed in its file format."""
+
+
+def get_record_batches_from_gcs(
+    blob_name,
+    bucket_name,
+    file_format=None,
+    chunk_size=GCS_CHUNK_SIZE,
+    batch_size=RECORDS_CHUNK_SIZE,
+    metrics=None,
+    extra_columns=(),
+):
+    """Get the user list from cloud storage as batches of columns.
+    The blob is read as successive byte ranges of chunk_size bytes and parsed
+    as the batches are consumed. Only the columns in USER_LIST_COLUMNS are
+    kept; for Parquet files, the other columns are not even downloaded.
     Args:
-        blob_name: The file of the file.
-        bucket_name: The bucket name in cloud storage
+        blob_name: The name of the file.
+        bucket_name: The bucket name in cloud storage.
+        file_format: One of FILE_FORMATS. If None, it is detected from the
+            name and content type of the blob.
+        chunk_size: The number of bytes requested from cloud storage at a time.
+        batch_size: The maximum number of records in a batch.
+        metrics: Optional UploadMetrics which records the time spent and the
+            bytes read from cloud storage as the "download" stage.
+        extra_columns: Names of other columns to keep, such as the column
+            that partitions the records between user lists.
     Returns:
-        A list of dicts, each dict represents a row from the user list.
+        An iterator of RecordBatch, which raises MalformedFileError if a
+        later batch cannot be parsed.
+    Raises:
+        google.api_core.exceptions.NotFound: If the bucket does not exist.
+        FileNotFoundError: If the blob does not exist.
+        ValueError: If the file format is not supported.
+        MalformedFileError: If the first batch cannot be parsed.
+    """
+    storage_client = get_storage_client()
+    bucket = storage_client.get_bucket(bucket_name)
+    blob = bucket.get_blob(blob_name)
+    if blob is None:
+        raise FileNotFoundError(f"gs://{bucket_name}/{blob_name} does not exist")
+
+    file_format = file_format or detect_file_format(blob)
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"Unsupported file format '{file_format}'")
+    print(f"Reading gs://{bucket_name}/{blob_name} as {file_format}.")
+    column_names = USER_LIST_COLUMNS + tuple(
+        name for name in extra_columns if name not in USER_LIST_COLUMNS
+    )
+    metrics = metrics or UploadMetrics()
+    record_batches = _iter_record_batches(blob, file_format, chunk_size, batch_size, metrics, column_names)
+    # Parses the first batch now, so that a file which is not in the format
+    # is rejected before any user list or job is created.
+    with metrics.stage("parse"):
+        first_batch = next(record_batches, None)
+    if first_batch is None:
+        return iter(())
+    return itertools.chain((first_batch,), record_batches)
+
+
+def detect_file_format(blob):
+    """Detects the format of a user list blob from its name and content type.
+    Args:
+        blob: The cloud storage blob.
+    Returns:
+        One of FILE_FORMATS. Defaults to "csv".
+    """
+    name = blob.name.lower()
+    content_type = (blob.content_type or "").split(";")[0].strip().lower()
+    compressed = name.endswith(".gz") or content_type in ("application/gzip", "application/x-gzip")
+    if name.endswith(".gz"):
+        name = name[:-len(".gz")]
+    # Cloud storage decompresses blobs stored with "Content-Encoding: gzip"
+    # when they are read, so their content is not compressed.
+    if blob.content_encoding == "gzip":
+        compressed = False
+
+    if name.endswith(".parquet") or content_type in ("application/vnd.apache.parquet", "application/x-parquet"):
+        return "parquet"
+    if name.endswith((".ndjson", ".jsonl", ".json")) or content_type in ("application/x-ndjson", "application/jsonl"):
+        return "ndjson.gz" if compressed else "ndjson"
+    return "csv.gz" if compressed else "csv"
+
+
+def _iter_record_batches(blob, file_format, chunk_size, batch_size, metrics, column_names=USER_LIST_COLUMNS):
+    """Parses a blob into batches while streaming it from cloud storage.
+    Args:
+        blob: The cloud storage blob to read.
+        file_format: One of FILE_FORMATS.
+        chunk_size: The number of bytes requested from cloud storage at a time.
+        batch_size: The maximum number of records in a batch.
+        metrics: UploadMetrics which records the reads from cloud storage.
+        column_names: The names of the columns to keep.
+    Yields:
+        RecordBatch objects.
+    Raises:
+        MalformedFileError: If the content is not valid in the file format.
+    """
+    with blob.open("rb", chunk_size=chunk_size) as blob_file:
+        raw_file = io.BufferedReader(_MeteredFile(blob_file, metrics), buffer_size=chunk_size)
+        try:
+            if file_format == "parquet":
+                yield from _iter_parquet_record_batches(raw_file, batch_size, column_names)
+                return
+
+            parse = _iter_csv_record_batches if file_format.startswith("csv") else _iter_ndjson_record_batches
+            if file_format.endswith(".gz"):
+                raw_file = gzip.GzipFile(fileobj=raw_file, mode="rb")
+            with io.TextIOWrapper(raw_file, encoding="utf-8", newline="") as file:
+                yield from parse(file, batch_size, column_names)
+        # UnicodeDecodeError and json.JSONDecodeError are ValueErrors, as is
+        # pyarrow's ArrowInvalid.
+        except (csv.Error, ValueError, EOFError, gzip.BadGzipFile) as e:
+            raise MalformedFileError(f"'{blob.name}' is not a valid {file_format} file: {e}") from e
+
+
+class _MeteredFile(io.RawIOBase):
+    """Read-only file which times the reads of another binary file as the
+    "download" stage of an UploadMetrics.
     """
-    file_path = "/tmp/file.csv"
-    try:
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(bucket_name)
-        blob = bucket.get_blob(blob_name)
-        blob.download_to_filename(filename=file_path)
-        with open(file_path) as file:
-            csv_reader = csv.DictReader(file)
-            records = list(csv_reader)
 
-        return records
+    def __init__(self, file, metrics):
+        self._file = file
+        self._metrics = metrics
 
-    except Exception as e:
-        message = "Failed to get file from cloud storage"
-        print(f"{message}: {e}")
-        return make_response({"message": message, "error": str(e)}, 404)
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def readinto(self, buffer):
+        with self._metrics.stage("download"):
+            data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        self._metrics.add("download", num_bytes=len(data))
+        return len(data)
+
+
+def _iter_csv_record_batches(file, batch_size, column_names=USER_LIST_COLUMNS):
+    """Parses CSV rows into batches, keeping only the used columns.
+    Like csv.DictReader, the first row is the header, blank rows are skipped
+    and short rows have no value for their missing columns; but no dict is
+    built for each row.
+    Args:
+        file: A text file object.
+        batch_size: The maximum number of records in a batch.
+        column_names: The names of the columns to keep.
+    Yields:
+        RecordBatch objects.
+    """
+    reader = csv.reader(file)
+    header = next(reader, None)
+    if header is None:
+        return
+    # When a column name is repeated, the last column wins, as with DictReader.
+    positions = {name: position for position, name in enumerate(header) if name in column_names}
+    rows = (row for row in reader if row)
+    row_number = 0
+    while True:
+        chunk = list(itertools.islice(rows, batch_size))
+        if not chunk:
+            return
+        columns = {
+            name: [row[position] if position < len(row) else None for row in chunk]
+            for name, position in positions.items()
+        }
+        yield RecordBatch(columns, range(row_number, row_number + len(chunk)), column_names)
+        row_number += len(chunk)
+
+
+def _iter_ndjson_record_batches(file, batch_size, column_names=USER_LIST_COLUMNS):
+    """Parses newline-delimited JSON objects into batches.
+    Args:
+        file: A text file object with one JSON object per line.
+        batch_size: The maximum number of records in a batch.
+        column_names: The names of the columns to keep.
+    Yields:
+        RecordBatch objects.
+    Raises:
+        ValueError: If a line is not a JSON object, or the file is a JSON
+            array.
+    """
+    lines = (line for line in file if line.strip())
+    row_number = 0
+    while True:
+        chunk = list(itertools.islice(lines, batch_size))
+        if not chunk:
+            return
+        # A ".json" blob may hold a JSON array rather than one object per line.
+        if row_number == 0 and chunk[0].lstrip().startswith("["):
+            raise ValueError("The file is a JSON array, not newline-delimited JSON objects")
+        objects = []
+        for offset, line in enumerate(chunk):
+            value = json.loads(line)
+            if not isinstance(value, dict):
+                raise ValueError(f"Row {row_number + offset} is not a JSON object")
+            objects.append(value)
+        columns = {
+            name: [_as_string(value.get(name)) for value in objects]
+            for name in column_names
+        }
+        yield RecordBatch(columns, range(row_number, row_number + len(chunk)), column_names)
+        row_number += len(chunk)
+
+
+def _iter_parquet_record_batches(file, batch_size, column_names=USER_LIST_COLUMNS):
+    """Reads the used columns of a Parquet file in batches.
+    Parquet files are read with random access, so only the byte ranges of the
+    used columns are downloaded. Requires the optional pyarrow package.
+    Args:
+        file: A seekable binary file object.
+        batch_size: The maximum number of records in a batch.
+        column_names: The names of the columns to keep.
+    Yields:
+        RecordBatch objects.
+    Raises:
+        ImportError: If pyarrow is not installed.
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Reading Parquet files requires the pyarrow package") from e
+
+    parquet_file = pq.ParquetFile(file)
+    names = [name for name in column_names if name in parquet_file.schema_arrow.names]
+    row_number = 0
+    for arrow_batch in parquet_file.iter_batches(batch_size=batch_size, columns=names):
+        data = arrow_batch.to_pydict()
+        columns = {name: [_as_string(value) for value in data[name]] for name in names}
+        yield RecordBatch(columns, range(row_number, row_number + arrow_batch.num_rows), column_names)
+        row_number += arrow_batch.num_rows
+
+
+def _as_string(value):
+    """Converts a parsed value to a string, keeping None for missing values."""
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
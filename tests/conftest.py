@@ -0,0 +1,164 @@
+import csv
+import os
+import sys
+import types
+
+import pytest
+from google.ads.googleads.errors import GoogleAdsException
+from google.protobuf import any_pb2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import main
+
+
+BUCKET_NAME = "bucket"
+CUSTOMER_ID = "1234567890"
+USER_LIST_ID = "987654321"
+
+
+class RecordingOfflineUserDataJobService(benchmark.FakeOfflineUserDataJobService):
+    """Fake OfflineUserDataJobService which numbers the jobs it creates, keeps
+    the operations it receives, and can fail or reject operations of chosen
+    requests.
+    """
+
+    def __init__(self, ga_client):
+        super().__init__(ga_client)
+        # Maps the resource name of each job to the one of its user list.
+        self.job_user_lists = {}
+        self.received = []
+        self.received_jobs = []
+        self.runs = []
+        # Maps the index of a request to an exception raised instead of
+        # accepting it, or to the indices of the operations it rejects.
+        self.errors = {}
+        self.rejections = {}
+        self.run_error = None
+        # Maps the resource name of a job to an exception raised when it runs.
+        self.run_errors = {}
+
+    def create_offline_user_data_job(self, customer_id, job):
+        self._count("create_offline_user_data_job")
+        resource_name = f"customers/{customer_id}/offlineUserDataJobs/{len(self.job_user_lists) + 1}"
+        self.job_user_lists[resource_name] = job.customer_match_user_list_metadata.user_list
+        return types.SimpleNamespace(resource_name=resource_name)
+
+    def add_offline_user_data_job_operations(self, request):
+        index = self.requests.get("add_offline_user_data_job_operations", 0)
+        self._count("add_offline_user_data_job_operations")
+        if index in self.errors:
+            raise self.errors[index]
+        self.received.append(list(request.operations))
+        self.received_jobs.append(request.resource_name)
+        if index in self.rejections:
+            return partial_failure_response(self._ga_client, self.rejections[index])
+        return self._ga_client.get_type("AddOfflineUserDataJobOperationsResponse")
+
+    def run_offline_user_data_job(self, resource_name):
+        self._count("run_offline_user_data_job")
+        if self.run_error is not None:
+            raise self.run_error
+        if resource_name in self.run_errors:
+            raise self.run_errors[resource_name]
+        self.runs.append(resource_name)
+
+    @property
+    def operations_received(self):
+        return [operation for operations in self.received for operation in operations]
+
+    def operations_by_user_list(self):
+        """Returns a dict mapping user list resource names to the operations
+        received by their jobs.
+        """
+        operations_by_user_list = {}
+        for job, operations in zip(self.received_jobs, self.received):
+            operations_by_user_list.setdefault(self.job_user_lists[job], []).extend(operations)
+        return operations_by_user_list
+
+
+def google_ads_exception(ga_client, status_code, retry_delay=None):
+    """Returns a GoogleAdsException with a gRPC status and an optional
+    requested retry delay, in seconds.
+    """
+    failure = ga_client.get_type("GoogleAdsFailure")
+    error = ga_client.get_type("GoogleAdsError")
+    error.message = status_code.name
+    if retry_delay is not None:
+        type(error).pb(error).details.quota_error_details.retry_delay.seconds = retry_delay
+    failure.errors.append(error)
+    return GoogleAdsException(types.SimpleNamespace(code=lambda: status_code), None, failure, "request")
+
+
+def partial_failure_response(ga_client, indices):
+    """Returns a response whose partial failure rejects the operations at the
+    given indices of the request.
+    """
+    failure = ga_client.get_type("GoogleAdsFailure")
+    for index in indices:
+        error = ga_client.get_type("GoogleAdsError")
+        error.message = f"Rejected operation {index}"
+        element = ga_client.get_type("ErrorLocation").FieldPathElement()
+        element.field_name = "operations"
+        element.index = index
+        error.location.field_path_elements.append(element)
+        failure.errors.append(error)
+    detail = any_pb2.Any(value=type(failure).serialize(failure))
+    return types.SimpleNamespace(partial_failure_error=types.SimpleNamespace(code=3, details=[detail]))
+
+
+def write_users_csv(bucket, blob_name, emails):
+    """Writes a CSV export with one user per email address."""
+    with open(bucket.blob(blob_name).path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(main.USER_LIST_COLUMNS)
+        for email in emails:
+            writer.writerow((email, "", "", "", "", ""))
+
+
+def hashed_emails(operations, kind="create"):
+    """Returns the hashed emails of the create or remove operations."""
+    return [
+        getattr(operation, kind).user_identifiers[0].hashed_email
+        for operation in operations
+        if kind in operation
+    ]
+
+
+@pytest.fixture
+def storage_client(tmp_path):
+    return benchmark.FakeStorageClient(str(tmp_path))
+
+
+@pytest.fixture
+def bucket(storage_client):
+    return storage_client.bucket(BUCKET_NAME)
+
+
+@pytest.fixture
+def ga_client():
+    client, _ = benchmark.make_google_ads_client()
+    return client
+
+
+@pytest.fixture
+def job_service(ga_client):
+    service = RecordingOfflineUserDataJobService(ga_client)
+    get_service = ga_client.get_service
+    ga_client.get_service = lambda name, version=None: (
+        service if name == "OfflineUserDataJobService" else get_service(name, version)
+    )
+    return service
+
+
+@pytest.fixture
+def clients(monkeypatch, ga_client, job_service, storage_client):
+    """Makes the function use the fake clients, without rate limiting."""
+    main.refresh_clients()
+    monkeypatch.setattr(main, "_google_ads_client", ga_client)
+    monkeypatch.setattr(main, "_storage_client", storage_client)
+    monkeypatch.setattr(main, "_rate_limiters", {
+        CUSTOMER_ID: main.RateLimiter(rate=1000.0, max_rate=1000.0, burst=1000),
+    })
+    return ga_client, job_service, storage_client
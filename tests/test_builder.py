@@ -0,0 +1,55 @@
+import pytest
+
+import main
+
+
+def reference_operation(ga_client, hashed_email, hashed_phone_number, address):
+    """Builds an operation field by field through proto-plus."""
+    operation = ga_client.get_type("OfflineUserDataJobOperation")
+    user_data = operation.create
+    if hashed_email is not None:
+        user_identifier = ga_client.get_type("UserIdentifier")
+        user_identifier.hashed_email = hashed_email
+        user_data.user_identifiers.append(user_identifier)
+    if hashed_phone_number is not None:
+        user_identifier = ga_client.get_type("UserIdentifier")
+        user_identifier.hashed_phone_number = hashed_phone_number
+        user_data.user_identifiers.append(user_identifier)
+    if address is not None:
+        user_identifier = ga_client.get_type("UserIdentifier")
+        address_info = user_identifier.address_info
+        (
+            address_info.hashed_first_name,
+            address_info.hashed_last_name,
+            address_info.country_code,
+            address_info.postal_code,
+        ) = address
+        user_data.user_identifiers.append(user_identifier)
+    return operation
+
+
+EMAIL = main.normalize_and_hash("a@example.com", True)
+PHONE = main.normalize_and_hash("+15550100", True)
+ADDRESS = (main.normalize_and_hash("Ada", False), main.normalize_and_hash("Lovelace", False), "GB", "W1")
+
+
+@pytest.mark.parametrize("identifiers", [
+    (EMAIL, PHONE, ADDRESS),
+    (EMAIL, None, None),
+    (None, PHONE, None),
+    (None, None, ADDRESS),
+    (EMAIL, None, ADDRESS),
+])
+def test_operations_serialize_like_proto_plus(ga_client, identifiers):
+    operation_type = type(ga_client.get_type("OfflineUserDataJobOperation"))
+
+    operation = main.get_operation_builder(ga_client).build(*identifiers)
+
+    assert isinstance(operation, operation_type)
+    assert operation_type.serialize(operation) == operation_type.serialize(
+        reference_operation(ga_client, *identifiers)
+    )
+
+
+def test_no_operation_without_identifiers(ga_client):
+    assert main.get_operation_builder(ga_client).build() is None
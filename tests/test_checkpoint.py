@@ -0,0 +1,112 @@
+import json
+
+import grpc
+
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, USER_LIST_ID, google_ads_exception, hashed_emails, write_users_csv
+
+JOB = f"customers/{CUSTOMER_ID}/offlineUserDataJobs/1"
+USER_LIST = f"customers/{CUSTOMER_ID}/userLists/{USER_LIST_ID}"
+
+
+def make_checkpoint(bucket, interval=3600):
+    return main.UploadCheckpoint(bucket, "users.csv", CUSTOMER_ID, USER_LIST_ID, interval=interval)
+
+
+def test_acknowledged_ranges_are_merged(bucket):
+    checkpoint = make_checkpoint(bucket)
+    checkpoint.start(JOB, USER_LIST)
+    for first, last in ((20, 29), (0, 9), (40, 49), (10, 19)):
+        checkpoint.acknowledge(first, last)
+
+    assert checkpoint.acknowledged_rows == 40
+    assert [row for row in range(-1, 51) if checkpoint.is_acknowledged(row)] == [*range(30), *range(40, 50)]
+
+
+def test_remove_all_is_saved_at_once(bucket):
+    checkpoint = make_checkpoint(bucket)
+    checkpoint.start(JOB, USER_LIST)
+    checkpoint.acknowledge(0, 9, remove_all=True)
+    checkpoint.acknowledge(10, 19)
+
+    reloaded = make_checkpoint(bucket)
+    assert reloaded.remove_all_acknowledged
+    # Other acknowledgements wait for the interval, or the end of the upload.
+    assert reloaded.acknowledged_rows == 10
+    checkpoint.save()
+    assert make_checkpoint(bucket).acknowledged_rows == 20
+
+
+def test_checkpoint_belongs_to_job_and_user_list(bucket):
+    checkpoint = make_checkpoint(bucket)
+    checkpoint.start(JOB, USER_LIST)
+    checkpoint.acknowledge(0, 9)
+    checkpoint.save()
+
+    reloaded = make_checkpoint(bucket)
+    assert reloaded.job_id(USER_LIST) == "1"
+    assert reloaded.job_id(f"customers/{CUSTOMER_ID}/userLists/1") is None
+    # Another job starts from scratch.
+    reloaded.start(f"customers/{CUSTOMER_ID}/offlineUserDataJobs/2", USER_LIST)
+    assert reloaded.acknowledged_rows == 0
+
+
+def test_checkpoints_are_named_after_the_user_list(bucket):
+    first = main.UploadCheckpoint(bucket, "users.csv", CUSTOMER_ID, "1")
+    second = main.UploadCheckpoint(bucket, "users.csv", CUSTOMER_ID, "2")
+    first.start(JOB, f"customers/{CUSTOMER_ID}/userLists/1")
+    second.start(f"customers/{CUSTOMER_ID}/offlineUserDataJobs/2", f"customers/{CUSTOMER_ID}/userLists/2")
+
+    assert bucket.blob(f"users.csv.{CUSTOMER_ID}.1.checkpoint.json").exists()
+    assert bucket.blob(f"users.csv.{CUSTOMER_ID}.2.checkpoint.json").exists()
+
+
+def test_resume_requires_user_list_id(clients):
+    _, job_service, _ = clients
+    body, status_code = main.upload_customer_match_user_list({
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.csv",
+        "customer_id": CUSTOMER_ID,
+        "resume": True,
+    })
+
+    assert status_code == 400
+    assert job_service.requests == {}
+
+
+def test_resume_skips_acknowledged_rows(clients, bucket):
+    _, job_service, _ = clients
+    emails = [f"user{index}@example.com" for index in range(30)]
+    write_users_csv(bucket, "users.csv", emails)
+    request_data = {
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.csv",
+        "customer_id": CUSTOMER_ID,
+        "user_list_id": USER_LIST_ID,
+        "checkpoint": True,
+        "max_operations_per_request": 10,
+        "max_requests_in_flight": 1,
+        "async": True,
+    }
+    # The third request fails with an error that is not retried.
+    job_service.errors[2] = google_ads_exception(clients[0], grpc.StatusCode.INVALID_ARGUMENT)
+
+    body, status_code = main.upload_customer_match_user_list(request_data)
+    assert status_code == 400
+    checkpoint_blob = bucket.blob(f"users.csv.{CUSTOMER_ID}.{USER_LIST_ID}.checkpoint.json")
+    checkpoint = json.loads(checkpoint_blob.download_as_bytes())
+    assert checkpoint["remove_all"]
+    assert checkpoint["rows"] == [[0, 18]]
+
+    job_service.errors.clear()
+    body, status_code = main.upload_customer_match_user_list({**request_data, "resume": True})
+    assert status_code == 200
+    assert body["job_id"] == 1
+    assert job_service.requests["create_offline_user_data_job"] == 1
+    operations = job_service.operations_received
+    assert sum(1 for operation in operations if operation.remove_all) == 1
+    assert sorted(hashed_emails(operations)) == sorted(
+        main.normalize_and_hash(email, True) for email in emails
+    )
+    # The job runs, so it can no longer be resumed.
+    assert not checkpoint_blob.exists()
@@ -0,0 +1,62 @@
+import random
+
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, USER_LIST_ID, hashed_emails, write_users_csv
+
+
+def test_fingerprint_set():
+    fingerprints = main.FingerprintSet(capacity=4)
+    rng = random.Random(0)
+    values = list({rng.getrandbits(64) or 1 for _ in range(1000)})
+
+    assert all(fingerprints.add(value) for value in values)
+    assert not any(fingerprints.add(value) for value in values)
+    assert len(fingerprints) == len(values)
+
+
+def test_fingerprint_set_holds_zero():
+    fingerprints = main.FingerprintSet()
+
+    assert fingerprints.add(0)
+    assert not fingerprints.add(0)
+    assert len(fingerprints) == 1
+
+
+def test_sorted_fingerprints_merge_runs():
+    rng = random.Random(0)
+    values = [rng.getrandbits(63) for _ in range(1000)]
+
+    sorted_values = main._sorted_fingerprints(iter(values), run_size=64)
+
+    assert list(sorted_values) == sorted(values)
+    assert main._contains(sorted_values, values[0])
+    assert not main._contains(sorted_values, max(values) + 1)
+
+
+def test_deduplicator_counts_duplicates_after_switching_to_fingerprints():
+    deduplicator = main.UserDataDeduplicator(exact_max_entries=2)
+    users = [f"user{index}".encode() for index in range(5)]
+
+    assert all(deduplicator.add(user) for user in users)
+    assert not any(deduplicator.add(user) for user in users)
+    assert deduplicator.duplicates == 5
+
+
+def test_duplicate_users_are_dropped(clients, bucket):
+    _, job_service, _ = clients
+    emails = ["a@example.com", " a@example.com", "b@example.com", "a@example.com", "c@example.com"]
+    write_users_csv(bucket, "users.csv", emails)
+
+    body, status_code = main.upload_customer_match_user_list({
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.csv",
+        "customer_id": CUSTOMER_ID,
+        "user_list_id": USER_LIST_ID,
+        "async": True,
+    })
+
+    assert status_code == 200
+    assert body["duplicates_dropped"] == 2
+    assert sorted(hashed_emails(job_service.operations_received)) == sorted(
+        main.normalize_and_hash(email, True) for email in ("a@example.com", "b@example.com", "c@example.com")
+    )
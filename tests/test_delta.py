@@ -0,0 +1,183 @@
+import grpc
+
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, USER_LIST_ID, google_ads_exception, hashed_emails, write_users_csv
+
+
+class RecordingUploader:
+    def __init__(self):
+        self.operations = []
+
+    def add(self, operation, row_number=None):
+        self.operations.append(operation)
+
+
+def make_operations(ga_client, emails):
+    operations = []
+    for row_number, email in enumerate(emails):
+        operation = ga_client.get_type("OfflineUserDataJobOperation")
+        user_identifier = ga_client.get_type("UserIdentifier")
+        user_identifier.hashed_email = main.normalize_and_hash(email, True)
+        operation.create.user_identifiers.append(user_identifier)
+        operations.append((row_number, operation))
+    return operations
+
+
+def upload_delta(ga_client, snapshot, emails):
+    uploader = RecordingUploader()
+    counts = main.add_user_list_delta_operations(
+        ga_client, uploader, iter(make_operations(ga_client, emails)), snapshot
+    )
+    return counts, uploader.operations
+
+
+def test_first_delta_upload_adds_every_member(ga_client, bucket):
+    snapshot = main.UserListSnapshot(bucket, CUSTOMER_ID, USER_LIST_ID)
+    counts, operations = upload_delta(ga_client, snapshot, ["a@example.com", "b@example.com"])
+
+    assert counts == {"added": 2, "removed": 0, "unchanged": 0}
+    assert len(hashed_emails(operations)) == 2
+    # The snapshot only changes when it is committed.
+    assert not snapshot.exists()
+
+
+def test_delta_upload_sends_the_difference(ga_client, bucket):
+    snapshot = main.UserListSnapshot(bucket, CUSTOMER_ID, USER_LIST_ID)
+    upload_delta(ga_client, snapshot, ["a@example.com", "b@example.com", "c@example.com"])
+    snapshot.commit()
+
+    counts, operations = upload_delta(ga_client, snapshot, ["b@example.com", "c@example.com", "d@example.com"])
+
+    assert counts == {"added": 1, "removed": 1, "unchanged": 2}
+    assert hashed_emails(operations, "remove") == [main.normalize_and_hash("a@example.com", True)]
+    assert hashed_emails(operations, "create") == [main.normalize_and_hash("d@example.com", True)]
+    # Removals are sent before additions.
+    assert "remove" in operations[0]
+
+
+def delta_request(bucket, emails):
+    write_users_csv(bucket, "users.csv", emails)
+    return {
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.csv",
+        "customer_id": CUSTOMER_ID,
+        "user_list_id": USER_LIST_ID,
+        "delta": True,
+        "async": True,
+    }
+
+
+def set_job_status(ga_client, status):
+    ga_client.get_service("GoogleAdsService").job_status = status
+
+
+def test_snapshot_is_promoted_once_the_job_succeeds(clients, bucket):
+    ga_client, job_service, _ = clients
+    set_job_status(ga_client, "SUCCESS")
+    body, status_code = main.upload_customer_match_user_list(
+        delta_request(bucket, ["a@example.com", "b@example.com"])
+    )
+    assert status_code == 200
+    assert body["delta"] == {"added": 2, "removed": 0, "unchanged": 0}
+    # The job has only been run, so the snapshot is still pending.
+    assert not main.UserListSnapshot(bucket, CUSTOMER_ID, USER_LIST_ID).exists()
+
+    body, status_code = main.upload_customer_match_user_list(
+        delta_request(bucket, ["a@example.com", "c@example.com"])
+    )
+    assert status_code == 200
+    assert body["delta"] == {"added": 1, "removed": 1, "unchanged": 1}
+    assert len(job_service.runs) == 2
+
+
+def test_snapshot_is_discarded_when_the_job_fails(clients, bucket):
+    ga_client, job_service, _ = clients
+    set_job_status(ga_client, "SUCCESS")
+    main.upload_customer_match_user_list(delta_request(bucket, ["a@example.com"]))
+    main.upload_customer_match_user_list(delta_request(bucket, ["a@example.com", "b@example.com"]))
+
+    set_job_status(ga_client, "FAILED")
+    body, status_code = main.upload_customer_match_user_list(
+        delta_request(bucket, ["a@example.com", "b@example.com"])
+    )
+    # The member added by the failed job is sent again.
+    assert status_code == 200
+    assert body["delta"] == {"added": 1, "removed": 0, "unchanged": 1}
+
+
+def test_snapshot_is_kept_when_the_run_fails(clients, bucket):
+    ga_client, job_service, _ = clients
+    set_job_status(ga_client, "SUCCESS")
+    main.upload_customer_match_user_list(delta_request(bucket, ["a@example.com"]))
+
+    job_service.run_error = google_ads_exception(ga_client, grpc.StatusCode.INVALID_ARGUMENT)
+    body, status_code = main.upload_customer_match_user_list(
+        delta_request(bucket, ["a@example.com", "b@example.com"])
+    )
+    assert status_code == 400
+
+    job_service.run_error = None
+    body, status_code = main.upload_customer_match_user_list(
+        delta_request(bucket, ["a@example.com", "b@example.com"])
+    )
+    # The member added by the failed upload is sent again.
+    assert body["delta"] == {"added": 1, "removed": 0, "unchanged": 1}
+
+
+def test_snapshot_is_kept_when_operations_are_rejected(clients, bucket):
+    ga_client, job_service, _ = clients
+    set_job_status(ga_client, "SUCCESS")
+    main.upload_customer_match_user_list(delta_request(bucket, ["a@example.com"]))
+
+    job_service.rejections[1] = [0]
+    body, status_code = main.upload_customer_match_user_list(
+        delta_request(bucket, ["a@example.com", "b@example.com"])
+    )
+    assert status_code == 200
+    assert body["partial_failures"]["count"] == 1
+    snapshot = main.UserListSnapshot(bucket, CUSTOMER_ID, USER_LIST_ID)
+    assert not bucket.blob(snapshot.pending_blob_name).exists()
+
+    body, status_code = main.upload_customer_match_user_list(
+        delta_request(bucket, ["a@example.com", "b@example.com"])
+    )
+    assert body["delta"] == {"added": 1, "removed": 0, "unchanged": 1}
+
+
+def test_members_are_uploaded_again_before_they_expire(clients, bucket, monkeypatch):
+    ga_client, job_service, _ = clients
+    set_job_status(ga_client, "SUCCESS")
+    now = 1700000000.0
+    monkeypatch.setattr(main.time, "time", lambda: now)
+    main.upload_customer_match_user_list(delta_request(bucket, ["a@example.com"]))
+    main.upload_customer_match_user_list(delta_request(bucket, ["a@example.com", "b@example.com"]))
+
+    now += (30 - main.DELTA_REFRESH_MARGIN_DAYS + 1) * 24 * 60 * 60
+    job_service.received.clear()
+    body, status_code = main.upload_customer_match_user_list(
+        delta_request(bucket, ["a@example.com", "b@example.com"])
+    )
+
+    assert status_code == 200
+    # Every member is uploaded again, replacing the user list.
+    assert body["delta"] == {"added": 2, "removed": 0, "unchanged": 0}
+    operations = job_service.operations_received
+    assert operations[0].remove_all
+    assert len(hashed_emails(operations)) == 2
+
+
+def test_unlimited_life_span_never_expires(clients, bucket, monkeypatch):
+    ga_client, job_service, _ = clients
+    set_job_status(ga_client, "SUCCESS")
+    ga_client.get_service("GoogleAdsService").membership_life_span = main.USER_LIST_UNLIMITED_LIFE_SPAN
+    now = 1700000000.0
+    monkeypatch.setattr(main.time, "time", lambda: now)
+    main.upload_customer_match_user_list(delta_request(bucket, ["a@example.com"]))
+    main.upload_customer_match_user_list(delta_request(bucket, ["a@example.com"]))
+
+    now += 365 * 24 * 60 * 60
+    body, status_code = main.upload_customer_match_user_list(
+        delta_request(bucket, ["a@example.com", "b@example.com"])
+    )
+
+    assert body["delta"] == {"added": 1, "removed": 0, "unchanged": 1}
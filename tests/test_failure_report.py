@@ -0,0 +1,89 @@
+import json
+
+from google.api_core.exceptions import Forbidden
+
+import benchmark
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, USER_LIST_ID, write_users_csv
+
+REPORT_BLOB_NAME = f"users.csv.{CUSTOMER_ID}.{USER_LIST_ID}.failures.ndjson"
+
+
+def upload(bucket, emails):
+    write_users_csv(bucket, "users.csv", emails)
+    return main.upload_customer_match_user_list({
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.csv",
+        "customer_id": CUSTOMER_ID,
+        "user_list_id": USER_LIST_ID,
+        "max_operations_per_request": 10,
+        "max_requests_in_flight": 2,
+        "async": True,
+    })
+
+
+def test_failures_are_mapped_to_source_rows(clients, bucket):
+    _, job_service, _ = clients
+    # The first request holds the remove_all operation and rows 0 to 8, the
+    # second one rows 9 to 18.
+    job_service.rejections[0] = [0, 4]
+    job_service.rejections[1] = [3]
+
+    body, status_code = upload(bucket, [f"user{index}@example.com" for index in range(30)])
+
+    assert status_code == 200
+    assert body["partial_failures"]["count"] == 3
+    assert body["partial_failures"]["blob_name"] == REPORT_BLOB_NAME
+    report = [json.loads(line) for line in bucket.blob(REPORT_BLOB_NAME).download_as_bytes().splitlines()]
+    assert [(failure["batch"], failure["index"], failure["row"], failure["operation"]) for failure in report] == [
+        (0, 0, None, "remove_all"),
+        (0, 4, 3, "create"),
+        (1, 3, 12, "create"),
+    ]
+
+
+def test_report_is_written_after_the_job_runs(clients, bucket, monkeypatch):
+    _, job_service, _ = clients
+    job_service.rejections[0] = [1]
+    runs_before_report = []
+    open_blob = benchmark.FakeBlob.open
+
+    def open_report(blob, mode="r", **kwargs):
+        if blob.name == REPORT_BLOB_NAME:
+            runs_before_report.append(len(job_service.runs))
+        return open_blob(blob, mode, **kwargs)
+
+    monkeypatch.setattr(benchmark.FakeBlob, "open", open_report)
+    upload(bucket, ["a@example.com", "b@example.com"])
+
+    assert runs_before_report == [1]
+
+
+def test_report_storage_errors_do_not_fail_the_upload(clients, bucket, monkeypatch):
+    _, job_service, _ = clients
+    job_service.rejections[0] = [1]
+    open_blob = benchmark.FakeBlob.open
+
+    def open_report(blob, mode="r", **kwargs):
+        if blob.name == REPORT_BLOB_NAME:
+            raise Forbidden("Missing storage.objects.create permission")
+        return open_blob(blob, mode, **kwargs)
+
+    monkeypatch.setattr(benchmark.FakeBlob, "open", open_report)
+    body, status_code = upload(bucket, ["a@example.com", "b@example.com"])
+
+    assert status_code == 200
+    assert len(job_service.runs) == 1
+    assert body["partial_failures"] == {"count": 1, "error_codes": {None: 1}, "blob_name": None}
+
+
+def test_report_of_a_clean_upload_is_deleted(clients, bucket):
+    _, job_service, _ = clients
+    job_service.rejections[0] = [1]
+    upload(bucket, ["a@example.com", "b@example.com"])
+    assert bucket.blob(REPORT_BLOB_NAME).exists()
+
+    body, status_code = upload(bucket, ["a@example.com", "b@example.com"])
+
+    assert body["partial_failures"]["count"] == 0
+    assert not bucket.blob(REPORT_BLOB_NAME).exists()
@@ -0,0 +1,50 @@
+import threading
+import time
+
+import flask
+
+import main
+
+
+def test_entries_of_a_customer_are_capped(monkeypatch):
+    lock = threading.Lock()
+    running = {}
+    peaks = {}
+
+    def upload(entry):
+        customer_id = entry["customer_id"]
+        with lock:
+            running[customer_id] = running.get(customer_id, 0) + 1
+            peaks[customer_id] = max(peaks.get(customer_id, 0), running[customer_id])
+        time.sleep(0.02)
+        with lock:
+            running[customer_id] -= 1
+        return {"customer_id": customer_id}, 200
+
+    monkeypatch.setattr(main, "upload_customer_match_user_list", upload)
+    entries = [{"customer_id": "1", "blob_name": f"{index}.csv"} for index in range(6)]
+    entries.append({"customer_id": "2", "blob_name": "other.csv"})
+
+    results = main.upload_customer_match_user_lists(entries, max_workers=4, max_workers_per_customer=2)
+
+    assert peaks == {"1": 2, "2": 1}
+    assert [result["blob_name"] for result in results] == [entry["blob_name"] for entry in entries]
+    assert all(result["status_code"] == 200 for result in results)
+
+
+def test_worker_counts_are_clamped(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        main,
+        "upload_customer_match_user_lists",
+        lambda entries, max_workers, max_workers_per_customer: calls.append(
+            (max_workers, max_workers_per_customer)
+        ) or [],
+    )
+    body = {"manifest": [], "max_workers": 10000, "max_workers_per_customer": 10000}
+
+    with flask.Flask(__name__).test_request_context(method="POST", json=body):
+        response = main.add_customer_match_user_lists(flask.request)
+
+    assert response.status_code == 200
+    assert calls == [(main.FAN_OUT_MAX_WORKERS_LIMIT, main.FAN_OUT_MAX_WORKERS_LIMIT)]
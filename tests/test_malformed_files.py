@@ -0,0 +1,45 @@
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, USER_LIST_ID
+
+
+def upload(blob_name, user_list_id=USER_LIST_ID):
+    request_data = {
+        "bucket_name": BUCKET_NAME,
+        "blob_name": blob_name,
+        "customer_id": CUSTOMER_ID,
+        "async": True,
+    }
+    if user_list_id is not None:
+        request_data["user_list_id"] = user_list_id
+    return main.upload_customer_match_user_list(request_data)
+
+
+def test_invalid_utf8_is_rejected_before_the_user_list_is_created(clients, bucket):
+    _, job_service, _ = clients
+    with open(bucket.blob("users.csv").path, "wb") as file:
+        file.write(b"Email\n\xff@example.com\n")
+
+    body, status_code = upload("users.csv", user_list_id=None)
+
+    assert status_code == 400
+    assert body["message"] == "Malformed file"
+    assert job_service.requests == {}
+
+
+def test_malformed_row_in_a_later_batch_does_not_run_the_job(clients, bucket, monkeypatch):
+    _, job_service, _ = clients
+    with open(bucket.blob("users.ndjson").path, "w") as file:
+        file.write('{"Email": "a@example.com"}\n{"Email": "b@example.com"}\n["c@example.com"]\n')
+    get_record_batches_from_gcs = main.get_record_batches_from_gcs
+    monkeypatch.setattr(
+        main,
+        "get_record_batches_from_gcs",
+        lambda **kwargs: get_record_batches_from_gcs(batch_size=2, **kwargs),
+    )
+
+    body, status_code = upload("users.ndjson")
+
+    assert status_code == 400
+    assert "Row 2 is not a JSON object" in body["error"]
+    assert job_service.requests["create_offline_user_data_job"] == 1
+    assert job_service.runs == []
@@ -0,0 +1,98 @@
+import csv
+
+import grpc
+
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, google_ads_exception, hashed_emails
+
+
+def user_list(user_list_id):
+    return f"customers/{CUSTOMER_ID}/userLists/{user_list_id}"
+
+
+def write_segmented_csv(bucket, rows):
+    with open(bucket.blob("users.csv").path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(("Email", "Segment"))
+        writer.writerows(rows)
+
+
+def upload(separator=None):
+    partition = {"column": "Segment", "user_lists": {"gold": 1, "silver": [2, 3]}}
+    if separator is not None:
+        partition["separator"] = separator
+    return main.upload_customer_match_user_list({
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.csv",
+        "customer_id": CUSTOMER_ID,
+        "partition": partition,
+        "async": True,
+    })
+
+
+def emails_by_user_list(job_service):
+    return {
+        resource_name: sorted(hashed_emails(operations))
+        for resource_name, operations in job_service.operations_by_user_list().items()
+    }
+
+
+def hashed(*emails):
+    return sorted(main.normalize_and_hash(email, True) for email in emails)
+
+
+def test_records_are_routed_by_the_partition_column(clients, bucket):
+    _, job_service, _ = clients
+    write_segmented_csv(bucket, [
+        ("a@example.com", "gold"),
+        ("b@example.com", " silver "),
+        ("c@example.com", "bronze"),
+        ("d@example.com", ""),
+    ])
+
+    body, status_code = upload()
+
+    assert status_code == 200
+    assert body["rows_unrouted"] == 2
+    assert emails_by_user_list(job_service) == {
+        user_list(1): hashed("a@example.com"),
+        user_list(2): hashed("b@example.com"),
+        user_list(3): hashed("b@example.com"),
+    }
+    # Each job starts with its remove_all operation.
+    assert all(operations[0].remove_all for operations in job_service.operations_by_user_list().values())
+
+
+def test_cells_with_a_separator_are_routed_to_each_value(clients, bucket):
+    _, job_service, _ = clients
+    write_segmented_csv(bucket, [("a@example.com", "gold; silver"), ("b@example.com", " gold")])
+
+    body, status_code = upload(separator=";")
+
+    assert status_code == 200
+    assert body["rows_unrouted"] == 0
+    assert emails_by_user_list(job_service) == {
+        user_list(1): hashed("a@example.com", "b@example.com"),
+        user_list(2): hashed("a@example.com"),
+        user_list(3): hashed("a@example.com"),
+    }
+
+
+def test_a_job_that_fails_to_run_does_not_stop_the_others(clients, bucket):
+    ga_client, job_service, _ = clients
+    write_segmented_csv(bucket, [("a@example.com", "gold"), ("b@example.com", "silver")])
+    failing_job = f"customers/{CUSTOMER_ID}/offlineUserDataJobs/2"
+    job_service.run_errors[failing_job] = google_ads_exception(ga_client, grpc.StatusCode.INVALID_ARGUMENT)
+
+    body, status_code = upload()
+
+    assert status_code == 200
+    assert [(result["user_list_id"], result.get("error")) for result in body["user_lists"]] == [
+        ("1", None),
+        ("2", "INVALID_ARGUMENT"),
+        ("3", None),
+    ]
+    assert job_service.runs == [
+        f"customers/{CUSTOMER_ID}/offlineUserDataJobs/1",
+        f"customers/{CUSTOMER_ID}/offlineUserDataJobs/3",
+    ]
@@ -0,0 +1,46 @@
+import hashlib
+
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, USER_LIST_ID, hashed_emails
+
+
+def upload(pre_hashed_columns):
+    return main.upload_customer_match_user_list({
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.csv",
+        "customer_id": CUSTOMER_ID,
+        "user_list_id": USER_LIST_ID,
+        "pre_hashed_columns": pre_hashed_columns,
+        "async": True,
+    })
+
+
+def test_pre_hashed_values_are_passed_through(clients, bucket):
+    _, job_service, _ = clients
+    digest = hashlib.sha256(b"a@example.com").hexdigest()
+    with open(bucket.blob("users.csv").path, "w") as file:
+        file.write(f"Email\n {digest.upper()} \nb@example.com\n{digest[:-1]}\n")
+
+    body, status_code = upload(["Email"])
+
+    assert status_code == 200
+    # Digests are only stripped and lowercased; other values are dropped.
+    assert hashed_emails(job_service.operations_received) == [digest]
+
+
+def test_invalid_pre_hashed_columns_are_rejected(clients):
+    _, job_service, _ = clients
+
+    for pre_hashed_columns in (["Country"], "Email", {"Email": True}):
+        body, status_code = upload(pre_hashed_columns)
+        assert (body, status_code) == ("Invalid pre-hashed columns", 400)
+    assert job_service.requests == {}
+
+
+def test_validation_keeps_only_digests():
+    digest = "ab" * 32
+    values = [digest, None, "AB" * 32, "xy" * 32, digest + "0"]
+
+    hashed = main._validate_pre_hashed_column("Email", values, [0, 2, 3, 4], len(values))
+
+    assert hashed == [digest, None, digest, None, None]
@@ -0,0 +1,77 @@
+import io
+
+import pytest
+
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, USER_LIST_ID
+
+
+def batches_as_rows(batches):
+    return [(list(batch.row_numbers), list(batch.iter_records())) for batch in batches]
+
+
+def test_csv_batches_keep_the_used_columns():
+    file = io.StringIO(
+        "Email,Customer ID,Phone\n"
+        "a@example.com,1,+15550100\n"
+        "\n"
+        "b@example.com,2\n"
+        "c@example.com,3,+15550102\n"
+    )
+
+    rows = batches_as_rows(main._iter_csv_record_batches(file, batch_size=2))
+
+    assert rows == [
+        ([0, 1], [{"Email": "a@example.com", "Phone": "+15550100"}, {"Email": "b@example.com"}]),
+        ([2], [{"Email": "c@example.com", "Phone": "+15550102"}]),
+    ]
+
+
+def test_csv_without_rows_has_no_batches():
+    assert list(main._iter_csv_record_batches(io.StringIO(""), batch_size=2)) == []
+    assert list(main._iter_csv_record_batches(io.StringIO("Email\n"), batch_size=2)) == []
+
+
+def test_ndjson_batches_read_values_as_strings():
+    file = io.StringIO(
+        '{"Email": "a@example.com", "Zip": 10001, "Segment": "gold"}\n'
+        "\n"
+        '{"Phone": "+15550101", "Email": null}\n'
+    )
+
+    rows = batches_as_rows(main._iter_ndjson_record_batches(file, batch_size=10))
+
+    assert rows == [([0, 1], [{"Email": "a@example.com", "Zip": "10001"}, {"Phone": "+15550101"}])]
+
+
+def test_ndjson_rows_must_be_objects():
+    file = io.StringIO('{"Email": "a@example.com"}\n["b@example.com"]\n')
+
+    with pytest.raises(ValueError, match="Row 1"):
+        list(main._iter_ndjson_record_batches(file, batch_size=10))
+
+
+def test_json_array_is_rejected_before_the_job_is_created(clients, bucket):
+    _, job_service, _ = clients
+    with open(bucket.blob("users.json").path, "w") as file:
+        file.write('[\n  {"Email": "a@example.com"},\n  {"Email": "b@example.com"}\n]\n')
+
+    body, status_code = main.upload_customer_match_user_list({
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.json",
+        "customer_id": CUSTOMER_ID,
+        "user_list_id": USER_LIST_ID,
+    })
+
+    assert status_code == 400
+    assert "JSON array" in body["error"]
+    assert job_service.requests == {}
+
+
+def test_record_batches_from_records():
+    records = [{"Email": "a@example.com"}, {"Phone": "+15550101"}, {"Email": "c@example.com"}]
+
+    batches = list(main.RecordBatch.iter_from_records(records, batch_size=2))
+
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert [record for batch in batches for record in batch.iter_records()] == records
@@ -0,0 +1,124 @@
+import grpc
+import pytest
+
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, USER_LIST_ID, google_ads_exception, write_users_csv
+
+
+class RpcError(grpc.RpcError):
+    def __init__(self, status_code):
+        self._status_code = status_code
+
+    def code(self):
+        return self._status_code
+
+
+class FailingCall:
+    """Function which raises the given errors before returning "done"."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(main.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_quota_errors_are_retried(ga_client, sleeps):
+    rate_limiter = main.RateLimiter(rate=1000.0, burst=1000)
+    call = FailingCall(
+        google_ads_exception(ga_client, grpc.StatusCode.RESOURCE_EXHAUSTED, retry_delay=5),
+        RpcError(grpc.StatusCode.RESOURCE_EXHAUSTED),
+    )
+    retries = []
+
+    assert main.call_with_retries(call, rate_limiter, on_retry=lambda: retries.append(1)) == "done"
+    assert call.calls == 3
+    assert len(retries) == 2
+    # The retry delay requested by the API is honoured.
+    assert sleeps[0] >= 5
+    assert rate_limiter.rate < 1000.0
+
+
+@pytest.mark.parametrize("status_code", [
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.INTERNAL,
+    grpc.StatusCode.INVALID_ARGUMENT,
+])
+def test_errors_of_calls_that_may_have_been_applied_are_not_retried(status_code, sleeps):
+    call = FailingCall(RpcError(status_code))
+
+    with pytest.raises(grpc.RpcError):
+        main.call_with_retries(call)
+    assert call.calls == 1
+    assert sleeps == []
+
+
+def test_exhausted_daily_quota_is_not_retried(ga_client, sleeps):
+    call = FailingCall(google_ads_exception(ga_client, grpc.StatusCode.RESOURCE_EXHAUSTED, retry_delay=3600))
+
+    with pytest.raises(main.GoogleAdsException):
+        main.call_with_retries(call, max_delay=60)
+    assert call.calls == 1
+
+
+def test_retries_stop_after_max_attempts(sleeps):
+    call = FailingCall(*[RpcError(grpc.StatusCode.RESOURCE_EXHAUSTED)] * 3)
+
+    with pytest.raises(grpc.RpcError):
+        main.call_with_retries(call, max_attempts=3)
+    assert call.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_rate_limiter_increases_and_decreases():
+    rate_limiter = main.RateLimiter(rate=10.0, min_rate=1.0, max_rate=10.5, increase=1.0, decrease_factor=0.5)
+    rate_limiter.on_success()
+    assert rate_limiter.rate == 10.5
+
+    assert rate_limiter.on_throttled() == 5.25
+    # Requests throttled together only lower the rate once.
+    assert rate_limiter.on_throttled() == 5.25
+
+    rate_limiter = main.RateLimiter(rate=1.5, min_rate=1.0, decrease_interval=0)
+    rate_limiter.on_throttled()
+    assert rate_limiter.on_throttled() == 1.0
+
+
+def test_rate_limiter_spaces_requests_after_a_burst(monkeypatch, sleeps):
+    now = [0.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(main.time, "sleep", lambda delay: (sleeps.append(delay), now.__setitem__(0, now[0] + delay)))
+    rate_limiter = main.RateLimiter(rate=2.0, burst=2)
+
+    for _ in range(4):
+        rate_limiter.acquire()
+
+    assert sleeps == [0.5, 0.5]
+
+
+def test_grpc_errors_are_answered(clients, bucket):
+    _, job_service, _ = clients
+    write_users_csv(bucket, "users.csv", ["a@example.com"])
+    job_service.run_error = RpcError(grpc.StatusCode.UNAVAILABLE)
+
+    body, status_code = main.upload_customer_match_user_list({
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.csv",
+        "customer_id": CUSTOMER_ID,
+        "user_list_id": USER_LIST_ID,
+    })
+
+    assert (body, status_code) == ("UNAVAILABLE", 503)
+    assert job_service.requests["run_offline_user_data_job"] == 1
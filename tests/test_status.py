@@ -0,0 +1,126 @@
+import flask
+
+import main
+from conftest import BUCKET_NAME, CUSTOMER_ID, USER_LIST_ID, write_users_csv
+
+
+def get_status(body):
+    with flask.Flask(__name__).test_request_context(method="POST", json=body):
+        response = main.get_offline_user_data_job_status(flask.request)
+    return response.get_json(silent=True) or response.get_data(as_text=True), response.status_code
+
+
+def record_queries(ga_client, monkeypatch):
+    """Returns the list of the customer IDs of the SearchStream requests."""
+    google_ads_service = ga_client.get_service("GoogleAdsService")
+    search_stream = google_ads_service.search_stream
+    queries = []
+
+    def record(customer_id, query):
+        queries.append(customer_id)
+        return search_stream(customer_id=customer_id, query=query)
+
+    monkeypatch.setattr(google_ads_service, "search_stream", record)
+    return queries
+
+
+def test_asynchronous_upload_returns_a_job_handle(clients, bucket):
+    ga_client, job_service, _ = clients
+    write_users_csv(bucket, "users.csv", ["a@example.com"])
+
+    body, status_code = main.upload_customer_match_user_list({
+        "bucket_name": BUCKET_NAME,
+        "blob_name": "users.csv",
+        "customer_id": CUSTOMER_ID,
+        "user_list_id": USER_LIST_ID,
+        "async": True,
+    })
+
+    assert status_code == 200
+    assert body["customer_id"] == CUSTOMER_ID
+    assert body["job_resource_name"] == f"customers/{CUSTOMER_ID}/offlineUserDataJobs/{body['job_id']}"
+    assert len(job_service.runs) == 1
+    status, status_code = get_status({"job_resource_names": [body["job_resource_name"]]})
+    assert status_code == 200
+    assert [(job["job_id"], job["status"]) for job in status["jobs"]] == [(body["job_id"], "PENDING")]
+
+
+def test_jobs_and_user_lists_are_retrieved_in_one_query_each(clients, monkeypatch):
+    ga_client, _, _ = clients
+    ga_client.get_service("GoogleAdsService").job_status = "SUCCESS"
+    queries = record_queries(ga_client, monkeypatch)
+
+    body, status_code = get_status({"customer_id": CUSTOMER_ID, "job_ids": [1, 2, 3], "user_list_ids": [7]})
+
+    assert status_code == 200
+    assert [(job["job_id"], job["status"]) for job in body["jobs"]] == [(1, "SUCCESS"), (2, "SUCCESS"), (3, "SUCCESS")]
+    assert [(user_list["user_list_id"], user_list["name"]) for user_list in body["user_lists"]] == [(7, "User list 7")]
+    assert queries == [CUSTOMER_ID, CUSTOMER_ID]
+
+
+def test_missing_jobs_are_reported(clients, monkeypatch):
+    ga_client, _, _ = clients
+    google_ads_service = ga_client.get_service("GoogleAdsService")
+    rows = google_ads_service._rows
+    monkeypatch.setattr(
+        google_ads_service,
+        "_rows",
+        lambda query: [row for row in rows(query) if row.offline_user_data_job.id != 2],
+    )
+
+    body, status_code = get_status({"customer_id": CUSTOMER_ID, "job_id": 1, "job_ids": [2]})
+
+    assert status_code == 200
+    assert [(job["job_id"], job["status"]) for job in body["jobs"]] == [(1, "PENDING"), (2, "NOT_FOUND")]
+    assert "user_lists" not in body
+
+
+def test_jobs_of_several_customers_are_retrieved_together(clients, monkeypatch):
+    queries = record_queries(clients[0], monkeypatch)
+    resource_names = ["customers/1/offlineUserDataJobs/1", "customers/2/offlineUserDataJobs/2"]
+
+    body, status_code = get_status({
+        "customer_id": "1",
+        "job_id": 3,
+        "job_resource_names": resource_names,
+        "user_list_resource_names": ["customers/2/userLists/4"],
+    })
+
+    assert status_code == 200
+    assert [job["resource_name"] for job in body["jobs"]] == ["customers/1/offlineUserDataJobs/3", *resource_names]
+    assert [user_list["user_list_id"] for user_list in body["user_lists"]] == [4]
+    assert queries == ["1", "2", "2"]
+
+
+def test_resources_are_queried_per_customer_in_chunks(clients, monkeypatch):
+    ga_client, _, _ = clients
+    queries = record_queries(ga_client, monkeypatch)
+    resource_names = [f"customers/1/offlineUserDataJobs/{job_id}" for job_id in range(1, 6)]
+    resource_names.append("customers/2/offlineUserDataJobs/1")
+
+    rows = list(main.search_resources(
+        ga_client,
+        "offline_user_data_job",
+        ["offline_user_data_job.resource_name"],
+        resource_names + resource_names[:1],
+        max_names_per_query=2,
+    ))
+
+    assert [row.offline_user_data_job.resource_name for row in rows] == resource_names
+    # Three queries for the first customer, one for the second.
+    assert queries == ["1", "1", "1", "2"]
+
+
+def test_invalid_resource_names_are_rejected(clients, monkeypatch):
+    queries = record_queries(clients[0], monkeypatch)
+
+    body, status_code = get_status({"job_resource_names": ["customers/1/offlineUserDataJobs/1' OR ''='"]})
+
+    assert (body, status_code) == ("Invalid resource names", 400)
+    assert queries == []
+
+
+def test_ids_require_a_customer_id(clients):
+    body, status_code = get_status({"job_ids": [1]})
+
+    assert (body, status_code) == ("Not enough data", 400)
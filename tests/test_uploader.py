@@ -0,0 +1,102 @@
+import threading
+import time
+
+import main
+from conftest import CUSTOMER_ID
+
+JOB = f"customers/{CUSTOMER_ID}/offlineUserDataJobs/1"
+
+
+def make_operation(ga_client, email):
+    operation = ga_client.get_type("OfflineUserDataJobOperation")
+    user_identifier = ga_client.get_type("UserIdentifier")
+    user_identifier.hashed_email = main.normalize_and_hash(email, True)
+    operation.create.user_identifiers.append(user_identifier)
+    return operation
+
+
+def upload(ga_client, count, **options):
+    uploader = main.OfflineUserDataJobOperationUploader(ga_client, JOB, **options)
+    try:
+        for index in range(count):
+            uploader.add(make_operation(ga_client, f"user{index}@example.com"), index)
+        uploader.close()
+    finally:
+        uploader.shutdown()
+    return uploader
+
+
+def test_requests_are_split_by_operation_count(clients):
+    ga_client, job_service, _ = clients
+
+    uploader = upload(ga_client, 7, max_operations_per_request=3, max_requests_in_flight=1)
+
+    assert [len(operations) for operations in job_service.received] == [3, 3, 1]
+    assert (uploader.requests_sent, uploader.operations_sent) == (3, 7)
+
+
+def test_requests_are_split_by_size(clients):
+    ga_client, job_service, _ = clients
+    max_request_bytes = 2048
+
+    upload(ga_client, 40, max_request_bytes=max_request_bytes, max_requests_in_flight=1)
+
+    request_type = type(ga_client.get_type("AddOfflineUserDataJobOperationsRequest"))
+    sizes = []
+    for operations in job_service.received:
+        request = ga_client.get_type("AddOfflineUserDataJobOperationsRequest")
+        request.resource_name = JOB
+        request.operations = operations
+        sizes.append(len(request_type.serialize(request)))
+    assert len(sizes) > 1
+    assert max(sizes) <= max_request_bytes
+    assert sum(len(operations) for operations in job_service.received) == 40
+
+
+def record_requests(job_service):
+    """Makes the job service slow, and returns the list of ("start", remove_all)
+    and ("end", remove_all) events of its requests, with the highest number of
+    requests in flight.
+    """
+    lock = threading.Lock()
+    events = []
+    in_flight = {"current": 0, "max": 0}
+    add_operations = job_service.add_offline_user_data_job_operations
+
+    def add_slowly(request):
+        remove_all = request.operations[0].remove_all
+        with lock:
+            events.append(("start", remove_all))
+            in_flight["current"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["current"])
+        time.sleep(0.02)
+        response = add_operations(request)
+        with lock:
+            in_flight["current"] -= 1
+            events.append(("end", remove_all))
+        return response
+
+    job_service.add_offline_user_data_job_operations = add_slowly
+    return events, in_flight
+
+
+def test_remove_all_is_acknowledged_before_other_requests(clients):
+    ga_client, job_service, _ = clients
+    events, in_flight = record_requests(job_service)
+
+    upload(ga_client, 20, remove_all=True, max_operations_per_request=2, max_requests_in_flight=4)
+
+    assert events[:2] == [("start", True), ("end", True)]
+    assert ("start", True) not in events[2:]
+    assert len(events) == 2 * 11
+    assert sum(1 for operation in job_service.operations_received if operation.remove_all) == 1
+
+
+def test_requests_in_flight_are_bounded(clients):
+    ga_client, job_service, _ = clients
+    events, in_flight = record_requests(job_service)
+
+    uploader = upload(ga_client, 40, max_operations_per_request=2, max_requests_in_flight=3)
+
+    assert uploader.requests_sent == 20
+    assert 1 < in_flight["max"] <= 3